@@ -0,0 +1,275 @@
+"""
+asyncio peer server for P2P file sharing app
+"""
+import asyncio
+import concurrent.futures
+import json
+import protocol
+
+# Requests being handled at once across all connections
+MAX_IN_FLIGHT = 64
+# Requests being handled at once on one connection (pipelined requests
+# beyond this stay unread in the socket, pushing back on the client)
+MAX_IN_FLIGHT_PER_CONNECTION = 16
+# Threads for file reads and request handling
+READ_WORKERS = 4
+# How often a request waiting for its file to be hashed looks again
+HASH_POLL = 0.05
+
+
+class Session:
+    """State of one framed connection"""
+
+    def __init__(self, writer, max_in_flight, registry):
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        # bytes are counted under the peer's listen address once the hello says it
+        self.address = self.peer
+        self.metrics = registry
+        self.write_lock = asyncio.Lock()
+        # requests being handled on this connection
+        self.slots = asyncio.Semaphore(max_in_flight)
+        # agreed on in the hello
+        self.framing = protocol.JSON_FRAMING
+        self.encoding = None
+        self.chokeable = False
+        self.chunk_sizes = False
+
+    async def send(self, response, payload=None):
+        """Write one message"""
+        async with self.write_lock:
+            data = self.framing.encode(response, payload)
+            self.writer.write(data)
+            if payload:
+                self.writer.write(payload)
+            self.metrics.peer_bytes(self.address, sent=len(data) + (len(payload) if payload else 0))
+            # backpressure: wait while the peer is behind on reading
+            await self.writer.drain()
+
+
+class AsyncServer:
+    """Serves every peer connection from one event loop
+
+    Speaks the same wire protocol as P2PNode.run_server: old clients
+    send one bare JSON request, new ones send framed requests on a
+    persistent connection. Request handling and chunk reads run on a
+    small thread pool so the loop never blocks on disk. Responses on a
+    connection are written as they finish (matched by request id) and
+    writer.drain() keeps a slow reader from piling up buffered chunks.
+    """
+
+    def __init__(self, node, idle_timeout, hash_wait, max_in_flight=MAX_IN_FLIGHT,
+                 max_in_flight_per_connection=MAX_IN_FLIGHT_PER_CONNECTION, workers=READ_WORKERS):
+        self.node = node
+        self.idle_timeout = idle_timeout
+        self.hash_wait = hash_wait
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_connection = max_in_flight_per_connection
+        self.workers = workers
+        self.executor = None
+        self.in_flight = None
+
+    def run(self):
+        """Run the server until the node stops (blocking)"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Accept connections until the node stops"""
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        server = await asyncio.start_server(self.handle_connection, '0.0.0.0', self.node.port,
+                                            reuse_address=True)
+        print(f"Listening on port {self.node.port} (asyncio)")
+
+        while self.node.running:
+            await asyncio.sleep(1.0)
+
+        server.close()
+        await server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        """Handle client connection"""
+        try:
+            first = await asyncio.wait_for(reader.read(1), 5.0)
+            if first == b'{':
+                await self.handle_single_request(first, reader, writer)
+            elif first:
+                await self.handle_framed_requests(first, reader, writer)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # server shutting down
+            pass
+        finally:
+            writer.close()
+
+    async def handle_single_request(self, first, reader, writer):
+        """One JSON request, then the connection is closed"""
+        data = first + await asyncio.wait_for(reader.read(4095), 5.0)
+        request = protocol.decode_header(data)
+        peer = writer.get_extra_info('peername')
+        self.node.metrics.peer_bytes(peer, received=len(data))
+
+        async with self.in_flight:
+            result = await self.run_request(request)
+        if result is None:
+            return
+
+        response, payload = result
+        if payload is None:
+            data = json.dumps(response).encode('utf-8')
+            writer.write(data)
+        else:
+            # one-off connection, only the total upload limit applies
+            await self.wait_upload(None, len(payload))
+            # header size + header + chunk
+            data = protocol.encode_header(response)
+            writer.write(data)
+            writer.write(payload)
+        self.node.metrics.peer_bytes(peer, sent=len(data) + (len(payload) if payload else 0))
+        await writer.drain()
+
+    async def handle_framed_requests(self, first, reader, writer):
+        """Serve requests on a persistent connection until it closes
+
+        Starts in JSON framing, a hello from the client switches it to
+        the version both sides speak.
+        """
+        session = Session(writer, self.max_in_flight_per_connection, self.node.metrics)
+        tasks = set()
+
+        prefix = first
+        try:
+            while self.node.running:
+                framing = session.framing
+                try:
+                    prefix += await asyncio.wait_for(
+                        reader.readexactly(framing.prefix_size - len(prefix)),
+                        self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # idle too long
+                    break
+                except asyncio.IncompleteReadError as e:
+                    if e.partial or prefix:
+                        raise ConnectionError("Connection closed in the middle of a message")
+                    break
+
+                meta_size = framing.meta_size(prefix)
+                protocol.check_size(meta_size, protocol.MAX_META_SIZE, "Message header")
+                meta = await reader.readexactly(meta_size)
+                request = framing.decode(prefix, meta)
+                payload_size = request.get('payload_size')
+                if payload_size:
+                    if not isinstance(payload_size, int):
+                        raise ConnectionError("Bad payload size")
+                    protocol.check_size(payload_size, protocol.MAX_PAYLOAD_SIZE, "Payload")
+                    await reader.readexactly(payload_size)
+
+                # next read starts fresh
+                size = len(prefix) + meta_size + (payload_size or 0)
+                prefix = b''
+
+                if request.get('type') == 'hello':
+                    session.address = self.node.peer_address(session.peer, request)
+                    self.node.metrics.peer_bytes(session.address, received=size)
+                    # the client waits for this before sending anything else
+                    response = self.node.handle_hello(request)
+                    await session.send(response)
+                    session.framing = protocol.FRAMINGS[response['version']]
+                    session.encoding = response.get('encoding')
+                    session.chokeable = 'choke' in response['features']
+                    session.chunk_sizes = 'chunk_size' in response['features']
+                    continue
+                self.node.metrics.peer_bytes(session.address, received=size)
+
+                # stop reading once this connection has enough requests going
+                await session.slots.acquire()
+                task = asyncio.create_task(self.answer(request, session))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            # frees its upload slot
+            self.node.uploads.disconnect(session.peer)
+
+    async def answer(self, request, session):
+        """Handle one framed request and write its response"""
+        try:
+            if session.chokeable and request.get('type') == 'chunk':
+                retry_after = self.node.uploads.check(session.peer)
+                if retry_after is not None:
+                    await session.send(self.node.choked(request, retry_after))
+                    return
+
+            async with self.in_flight:
+                result = await self.run_request(request, session.encoding, session.chunk_sizes)
+            if result is None:
+                result = ({'type': 'error', 'error': 'Unknown request type'}, None)
+
+            response, payload = result
+            response['id'] = request.get('id')
+            if payload:
+                await self.wait_upload(session.peer, len(payload))
+            await session.send(response, payload)
+        except (OSError, ValueError):
+            session.writer.close()
+        finally:
+            session.slots.release()
+
+    async def wait_upload(self, peer, nbytes):
+        """Wait (without blocking the loop) until the upload limits let nbytes go"""
+        delay = self.node.uploads.throttle(peer, nbytes)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.node.uploads.throttle(peer, nbytes)
+
+    async def wait_hashed(self, request):
+        """Wait for the file an info or chunk request is for to be hashed
+
+        Waits on the loop, so a file that takes a while doesn't hold one
+        of the few worker threads. Returns False if it wasn't in time.
+        """
+        if request.get('type') not in ('info', 'chunk'):
+            return True
+        filename = request.get('filename')
+        if not isinstance(filename, str):
+            # the handler answers that one
+            return True
+        file_info = self.node.files.get(filename)
+        if file_info is None or 'hash' in file_info:
+            return True
+        self.node.hash_queue.bump(filename)
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.hash_wait
+        while filename in self.node.hash_queue:
+            if loop.time() >= end:
+                return False
+            await asyncio.sleep(HASH_POLL)
+        return True
+
+    async def run_request(self, request, encoding=None, chunk_sizes=False):
+        """Run the node's request handler (and any file read) off the loop"""
+        if not await self.wait_hashed(request):
+            return self.node.still_hashing()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.handle_request, request,
+                                          encoding, chunk_sizes)
+
+    def handle_request(self, request, encoding=None, chunk_sizes=False):
+        """Node handler with file payloads read into bytes (worker thread)"""
+        result = self.node.handle_request(request, chunk_sizes)
+        if result is None:
+            return None
+
+        response, payload = result
+        if encoding:
+            # compressing reads the chunk into bytes itself
+            response, payload = self.node.encode_chunk(response, payload, encoding)
+        if isinstance(payload, protocol.FileRegion):
+            try:
+                payload = payload.read()
+            finally:
+                protocol.close_payload(result[1])
+        return response, payload
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Loopback benchmark for P2P file sharing app
+
+Starts N nodes on 127.0.0.1, each sharing its own temp dir, connects
+them in a topology, spreads synthetic files over them and measures
+index build time, search latency, download throughput and peak RSS.
+Results are printed (or written) as JSON so runs can be compared.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import node as N
+
+# Ways to connect the nodes
+TOPOLOGIES = ('full', 'star', 'ring', 'line')
+# Synthetic files are written in pieces this big
+WRITE_SIZE = 1024 * 1024
+# Give up waiting for the nodes to hash their files after this long
+INDEX_TIMEOUT = 300.0
+
+
+def log(message):
+    """Progress goes to stderr (stdout is for the JSON)"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def edges(topology, n):
+    """(a, b) node index pairs to connect"""
+    if topology == 'full':
+        return [(a, b) for a in range(n) for b in range(a + 1, n)]
+    if topology == 'star':
+        return [(0, b) for b in range(1, n)]
+    if topology == 'ring' and n > 2:
+        return [(a, (a + 1) % n) for a in range(n)]
+    # line (and a ring of two)
+    return [(a, a + 1) for a in range(n - 1)]
+
+
+def percentiles(samples):
+    """count, avg, p50, p90, p99 and max of samples (nearest rank)"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def rank(q):
+        return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+    return {
+        'count': len(ordered),
+        'avg': sum(ordered) / len(ordered),
+        'p50': rank(0.5),
+        'p90': rank(0.9),
+        'p99': rank(0.99),
+        'max': ordered[-1]
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (all nodes share it)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def make_files(dirs, count, size):
+    """Write count random files of size bytes, round robin over dirs
+
+    Returns {filename: owner node index}.
+    """
+    owners = {}
+    for i in range(count):
+        owner = i % len(dirs)
+        filename = f"bench_{i:04d}.bin"
+        with open(os.path.join(dirs[owner], filename), 'wb') as f:
+            left = size
+            while left > 0:
+                n = min(WRITE_SIZE, left)
+                f.write(os.urandom(n))
+                left -= n
+        owners[filename] = owner
+    return owners
+
+
+def wait_indexed(nodes, timeout=INDEX_TIMEOUT):
+    """Wait until every node has hashed and published its files"""
+    end = time.time() + timeout
+    while time.time() < end:
+        if all(len(node.hash_queue) == 0
+               and all('hash' in info for info in node.files.values())
+               for node in nodes):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def bench_search(nodes, owners, searches):
+    """Time searches from every node, returns latencies in seconds"""
+    filenames = sorted(owners)
+    latencies = []
+    for node in nodes:
+        for i in range(searches):
+            # mix of exact names, a prefix that matches everything and misses
+            kind = i % 3
+            if kind == 0 and filenames:
+                query = random.choice(filenames)
+            elif kind == 1:
+                query = 'bench'
+            else:
+                query = f"missing_{i}"
+            start = time.perf_counter()
+            node.search_files(query)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_downloads(nodes, swarm):
+    """Every node downloads each file a direct peer has (nodes run at once)
+
+    Returns (per file results, wall seconds).
+    """
+    results = []
+    lock = threading.Lock()
+
+    def fetch(node):
+        # what the node's peers offer, first source per file
+        sources = {}
+        for hit in node.search_files('bench'):
+            if hit['peer'] != 'local':
+                sources.setdefault(hit['filename'], (hit['peer'], hit['size']))
+        for filename, (peer, size) in sorted(sources.items()):
+            start = time.perf_counter()
+            ok = node.download_file(peer, filename, swarm)
+            seconds = time.perf_counter() - start
+            with lock:
+                results.append({'ok': ok, 'bytes': size, 'seconds': seconds})
+
+    threads = [threading.Thread(target=fetch, args=(node,), daemon=True) for node in nodes]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def run(args):
+    """Run the benchmark, returns the results dict"""
+    random.seed(args.seed)
+    root = tempfile.mkdtemp(prefix='p2p_bench_')
+    dirs = [os.path.join(root, f"node{i}") for i in range(args.nodes)]
+    for d in dirs:
+        os.makedirs(d)
+    nodes = []
+    # the nodes print status and progress lines, keep them out of the results
+    quiet = open(os.devnull, 'w') if not args.verbose else None
+    try:
+        size = int(args.size * 1024)
+        log(f"Writing {args.files} files of {args.size} KB...")
+        owners = make_files(dirs, args.files, size)
+
+        with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+            nodes = [N.P2PNode(d, server_mode=args.server) for d in dirs]
+            log(f"Starting {args.nodes} nodes ({args.server})...")
+            start = time.perf_counter()
+            for node in nodes:
+                node.start()
+            indexed = wait_indexed(nodes)
+            index_seconds = time.perf_counter() - start
+
+            for a, b in edges(args.topology, args.nodes):
+                nodes[a].add_peer('127.0.0.1', nodes[b].port)
+                nodes[b].add_peer('127.0.0.1', nodes[a].port)
+
+            log(f"Searching ({args.searches} per node, {args.topology})...")
+            latencies = bench_search(nodes, owners, args.searches)
+
+            log("Downloading...")
+            downloads, download_seconds = bench_downloads(nodes, args.swarm)
+
+        ok = [d for d in downloads if d['ok']]
+        total_bytes = sum(d['bytes'] for d in ok)
+        rates = [d['bytes'] / d['seconds'] / (1024 * 1024) for d in ok if d['seconds'] > 0]
+        return {
+            'config': {
+                'nodes': args.nodes,
+                'topology': args.topology,
+                'files': args.files,
+                'file_size': size,
+                'server': args.server,
+                'swarm': args.swarm,
+                'searches': args.searches,
+                'seed': args.seed
+            },
+            'index': {
+                'complete': indexed,
+                'seconds': index_seconds,
+                'mb_per_s': args.files * size / (1024 * 1024) / index_seconds if index_seconds else None
+            },
+            'search_ms': {k: v * 1000 if k != 'count' else v
+                          for k, v in percentiles(latencies).items()},
+            'download': {
+                'files': len(downloads),
+                'failed': len(downloads) - len(ok),
+                'bytes': total_bytes,
+                'seconds': download_seconds,
+                # everything the nodes moved together per wall second
+                'mb_per_s': total_bytes / (1024 * 1024) / download_seconds if download_seconds else None,
+                'file_mb_per_s': percentiles(rates)
+            },
+            'peak_rss_mb': peak_rss_mb()
+        }
+    finally:
+        with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+            stoppers = [threading.Thread(target=node.stop) for node in nodes]
+            for thread in stoppers:
+                thread.start()
+            for thread in stoppers:
+                thread.join()
+        if quiet:
+            quiet.close()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="P2P loopback benchmark")
+    parser.add_argument("--nodes", type=int, default=4, help="Nodes to start")
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="full",
+                        help="How the nodes are connected")
+    parser.add_argument("--files", type=int, default=8, help="Synthetic files, spread over the nodes")
+    parser.add_argument("--size", type=float, default=4096, help="Size of each file in KB")
+    parser.add_argument("--searches", type=int, default=30, help="Searches run from each node")
+    parser.add_argument("--server", choices=["thread", "asyncio"], default="thread",
+                        help="Server mode of the nodes")
+    parser.add_argument("--swarm", action="store_true",
+                        help="Download from every peer that has the file")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the search queries")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show the nodes' output")
+
+    args = parser.parse_args()
+    if args.nodes < 2:
+        parser.error("--nodes must be at least 2")
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        log(f"Wrote {args.output}")
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
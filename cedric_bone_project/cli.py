@@ -2,8 +2,10 @@
 Command-line interface for P2P file sharing app
 """
 import sys
-import threading
+import json
+import time
 import utils
+import download_queue
 
 class CommandLine:
     """Command-line interface"""
@@ -16,6 +18,13 @@ class CommandLine:
             'peers': (self.peers, 'List peers'),
             'connect': (self.connect, 'Connect to a peer'),
             'download': (self.download, 'Download a file'),
+            'swarm': (self.swarm, 'Download a file from every peer that has it'),
+            'stats': (self.stats, 'Show metrics (stats json [file] dumps them)'),
+            'queue': (self.queue, 'List downloads'),
+            'pause': (self.pause, 'Pause a download'),
+            'resume': (self.resume, 'Resume a paused or failed download'),
+            'cancel': (self.cancel, 'Cancel a download'),
+            'priority': (self.priority, 'Change the priority of a waiting download'),
         }
         self.search_results = []
     
@@ -28,6 +37,9 @@ class CommandLine:
         print("Use 'list' to list local files")
         print("Use 'peers' to list connected peers")
         print("Use 'download' to download a file")
+        print("Use 'swarm' to download a file from every peer that has it")
+        print("Use 'stats' to show counters and latencies")
+        print("Use 'queue' to list downloads, 'pause', 'resume', 'cancel' and 'priority' to control them")
         self.node.start()
         
         try:
@@ -63,28 +75,38 @@ class CommandLine:
         '''
         query = ' '.join(args)
 
-        # search
+        # search (results print as each peer answers)
         print(f"Searching for '{query}'...")
-        self.search_results = self.node.search_files(query)
-
-        # print results
         print("\nSearch results:")
-        for i, result in enumerate(self.search_results):
-            # print(result)
-            if result['peer'] == 'local':
-                peer_str = 'Local'
-            else:   
-                peer_str = f"{result['peer'][0]}:{result['peer'][1]}"
-            size_str = result['size']
+        self.search_results = []
+        self.node.search_files(query, on_result=self.print_result, on_error=self.print_search_error)
+        if not self.search_results:
+            print("  No results")
+    
+    def print_result(self, result):
+        """Print one search result as it arrives"""
+        i = len(self.search_results)
+        self.search_results.append(result)
+        # print(result)
+        if result['peer'] == 'local':
+            peer_str = 'Local'
+        else:   
+            peer_str = f"{result['peer'][0]}:{result['peer'][1]}"
+        size_str = result['size']
 
-            print(f" [{i}] {result['filename']} ({size_str}) - {peer_str}")
+        print(f" [{i}] {result['filename']} ({size_str}) - {peer_str}")
+    
+    def print_search_error(self, peer, reason):
+        """Print a peer that failed to answer"""
+        print(f"  ({peer[0]}:{peer[1]} skipped: {reason})")
     
     def list(self, args):
         """List local files"""
-        files = self.node.get_files()
+        # one snapshot so a re-index mid-listing can't remove entries
+        files = self.node.files
         print("\nLocal files:")
         for filename in files:
-            size_str = self.node.files[filename]['size']
+            size_str = files[filename]['size']
             print(f"  {filename} ({size_str})")
     
     def peers(self, args):
@@ -93,7 +115,65 @@ class CommandLine:
         # print(peers)
         print("\nConnected peers:")
         for i, peer in enumerate(peers):
-            print(f"  [{i}] {peer[0]}:{peer[1]}")
+            stats = self.node.peer_stats.snapshot(peer)
+            rtt_str = f"{stats['rtt'] * 1000:.1f} ms" if stats['rtt'] is not None else "-"
+            rate_str = f"{stats['throughput'] / (1024 * 1024):.2f} MB/s" if stats['throughput'] else "-"
+            if stats['last_seen'] is not None:
+                seen_str = f"{time.time() - stats['last_seen']:.0f}s ago"
+            else:
+                seen_str = "never"
+            line = (f"  [{i}] {peer[0]}:{peer[1]}  rtt {rtt_str}  {rate_str}  "
+                    f"failures {stats['failures']} ({stats['total_failures']} total)  seen {seen_str}")
+            if stats['backoff']:
+                line += f"  backing off {stats['backoff']:.0f}s"
+            print(line)
+    
+    def stats(self, args):
+        """Show metrics"""
+        if args and args[0] == 'json':
+            if len(args) > 1:
+                try:
+                    self.node.metrics.dump(args[1], self.node.metrics_extra())
+                except OSError as e:
+                    print(f"Could not write metrics: {e}")
+                    return
+                print(f"Wrote metrics to {args[1]}")
+            else:
+                snapshot = self.node.metrics.snapshot()
+                snapshot.update(self.node.metrics_extra())
+                print(json.dumps(snapshot, indent=2))
+            return
+        
+        snapshot = self.node.metrics.snapshot()
+        if not snapshot['enabled']:
+            print("Metrics are off (started with --no-metrics)")
+            self.print_upload_stats()
+            return
+        print(f"\nMetrics ({snapshot['uptime']:.0f}s):")
+        print("  Counters:")
+        for name, value in sorted(snapshot['counters'].items()):
+            print(f"    {name:<20} {value}")
+        print("  Latency (ms):        count      avg      p50      p90      p99      max")
+        for name, h in sorted(snapshot['latency'].items()):
+            print(f"    {name:<20} {h['count']:>5} " + " ".join(
+                f"{h[k] * 1000:>8.2f}" for k in ('avg', 'p50', 'p90', 'p99', 'max')))
+        print("  Peers (MB):          in      out")
+        for peer, b in sorted(snapshot['peers'].items()):
+            print(f"    {peer:<20} {b['in'] / (1024 * 1024):>5.1f} {b['out'] / (1024 * 1024):>8.1f}")
+        self.print_upload_stats()
+    
+    def print_upload_stats(self):
+        """Chunk cache and upload slot lines of stats"""
+        extra = self.node.metrics_extra()
+        cache = extra['chunk_cache']
+        lookups = cache['hits'] + cache['misses']
+        hit_rate = f"{cache['hits'] / lookups * 100:.0f}%" if lookups else "-"
+        print(f"  Chunk cache: {cache['chunks']} chunks, {cache['bytes'] / (1024 * 1024):.1f}"
+              f"/{cache['max_bytes'] / (1024 * 1024):.0f} MB, hits {cache['hits']} "
+              f"misses {cache['misses']} ({hit_rate}), evictions {cache['evictions']}")
+        uploads = extra['uploads']
+        print(f"  Uploads: {uploads['unchoked']}/{uploads['slots']} slots unchoked, "
+              f"{uploads['choked']} choked")
     
     def connect(self, args):
         """Connect to peer"""
@@ -106,12 +186,15 @@ class CommandLine:
 
 
     
-    def download(self, args):
-        """Download a file"""
+    def download(self, args, swarm=False):
+        """Queue a file for download (download index [high|normal|low])"""
         index = int(args[0])
         if (index < 0) or (index >= len(self.search_results)):
             print(f"Invalid index")
             return
+        priority = self.parse_priority(args[1] if len(args) > 1 else 'normal')
+        if priority is None:
+            return
         
         result = self.search_results[index]
         
@@ -119,16 +202,95 @@ class CommandLine:
         if result['peer'] == 'local':
             return
         
-        print(f"Downloading '{result['filename']}' from {result['peer'][0]}:{result['peer'][1]}...")
-        
-        # Download in anothher thread
-        threading.Thread(
-            target=self.download_thread,
-            args=(result['peer'], result['filename']),
-            daemon=True
-        ).start()
-    
-    def download_thread(self, peer, filename):
-        """Thread function for downloading"""
-        self.node.download_file(peer, filename)
-        print(f"\nDownloaded {filename}")
\ No newline at end of file
+        # the node's download queue runs it (a few at a time)
+        job = self.node.downloads.add(result['peer'], result['filename'], swarm, priority)
+        if job is None:
+            print(f"'{result['filename']}' is already in the queue")
+            return
+        print(f"Queued '{result['filename']}' from {result['peer'][0]}:{result['peer'][1]} as #{job.id}")
+    
+    def swarm(self, args):
+        """Download a file from every peer that has it"""
+        self.download(args, swarm=True)
+    
+    def queue(self, args):
+        """List downloads"""
+        jobs = self.node.downloads.snapshot()
+        print("\nDownloads:")
+        if not jobs:
+            print("  None")
+        for job in jobs:
+            line = (f"  #{job['id']} {job['filename']} from {job['peer'][0]}:{job['peer'][1]}"
+                    f"  {job['state']}  {job['priority']}")
+            if job['swarm']:
+                line += "  swarm"
+            if job['progress'] is not None:
+                done_bytes, size, rate, eta = job['progress']
+                percent = done_bytes / size * 100 if size else 100.0
+                line += (f"  {percent:.1f}%  {rate / (1024 * 1024):.2f} MB/s"
+                         f"  ETA {utils.format_eta(eta)}")
+            if job['error']:
+                line += f"  ({job['error']})"
+            print(line)
+    
+    def job_id(self, args):
+        """Download id from the first argument (None if missing or bad)"""
+        try:
+            return int(args[0].lstrip('#'))
+        except (IndexError, ValueError):
+            print("Give a download id (see 'queue')")
+            return None
+    
+    @staticmethod
+    def parse_priority(name):
+        """Priority level from its name (None if unknown)"""
+        priority = download_queue.PRIORITIES.get(name.lower())
+        if priority is None:
+            print(f"Priority must be one of: {', '.join(download_queue.PRIORITIES)}")
+        return priority
+    
+    def pause(self, args):
+        """Pause a download (its chunks are kept)"""
+        job_id = self.job_id(args)
+        if job_id is None:
+            return
+        if self.node.downloads.pause(job_id):
+            print(f"Pausing #{job_id}")
+        else:
+            print(f"#{job_id} isn't queued or running")
+    
+    def resume(self, args):
+        """Resume a paused or failed download"""
+        job_id = self.job_id(args)
+        if job_id is None:
+            return
+        if self.node.downloads.resume(job_id):
+            print(f"Resumed #{job_id}")
+        else:
+            print(f"#{job_id} isn't paused or failed")
+    
+    def cancel(self, args):
+        """Cancel a download and delete what it fetched"""
+        job_id = self.job_id(args)
+        if job_id is None:
+            return
+        if self.node.downloads.cancel(job_id):
+            print(f"Cancelling #{job_id}")
+        else:
+            print(f"#{job_id} can't be cancelled")
+    
+    def priority(self, args):
+        """Change the priority of a waiting download (priority id high|normal|low)"""
+        job_id = self.job_id(args)
+        if job_id is None:
+            return
+        if len(args) < 2:
+            print("Give a priority (high, normal or low)")
+            return
+        priority = self.parse_priority(args[1])
+        if priority is None:
+            return
+        if self.node.downloads.set_priority(job_id, priority):
+            print(f"#{job_id} is now {args[1].lower()} priority")
+        else:
+            print(f"#{job_id} has already started or finished")
\ No newline at end of file
@@ -0,0 +1,335 @@
+"""
+Persistent peer connections for P2P file sharing app
+"""
+import json
+import socket
+import threading
+import compression
+import metrics
+import protocol
+
+# Reader wakes up this often to check if the connection was closed
+READ_TIMEOUT = 30.0
+# Wait this long for the hello response (original nodes never send one,
+# so this has to stay well under the search deadline)
+HELLO_TIMEOUT = 1.0
+
+
+class PendingRequest:
+    """Slot for the response to one in-flight request"""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.event = threading.Event()
+        self.header = None
+        self.payload = None
+        self.error = None
+
+    def set_result(self, header, payload):
+        """Response arrived"""
+        self.header = header
+        self.payload = payload
+        self.event.set()
+
+    def set_error(self, error):
+        """Connection failed before the response arrived"""
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout):
+        """Wait for the response, returns (header, payload)"""
+        if not self.event.wait(timeout):
+            raise socket.timeout(f"Request {self.request_id} timed out")
+        if self.error is not None:
+            raise self.error
+        return self.header, self.payload
+
+
+class LegacyPeer(Exception):
+    """Peer didn't answer the hello, it only knows bare JSON"""
+
+
+class PeerConnection:
+    """One long-lived connection to a peer shared by many requests
+
+    Every request gets an id and responses are matched back to their
+    request by id, so any number of requests can be in flight at once.
+    The connection starts with a hello that picks the highest protocol
+    version both sides speak. Bytes both ways are counted in registry
+    under the peer's address; listen_port tells the peer ours, so it
+    counts us under the same address.
+    """
+
+    def __init__(self, peer, timeout=5.0, registry=None, listen_port=None):
+        self.peer = peer
+        self.metrics = registry or metrics.Registry(enabled=False)
+        self.listen_port = listen_port
+        self.sock = socket.create_connection(peer, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.framing = self.handshake()
+        except BaseException:
+            self.sock.close()
+            raise
+        self.version = self.framing.version
+        self.sock.settimeout(READ_TIMEOUT)
+
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+
+        self.reader_thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader_thread.start()
+
+    def handshake(self):
+        """Agree on a protocol version, returns its framing"""
+        hello = {
+            'type': 'hello',
+            'versions': protocol.SUPPORTED_VERSIONS,
+            # chunk encodings we can decode, the server picks one (or none)
+            'encodings': compression.ENCODINGS,
+            'features': protocol.FEATURES
+        }
+        if self.listen_port is not None:
+            hello['port'] = self.listen_port
+        self.sock.settimeout(HELLO_TIMEOUT)
+        try:
+            sent = protocol.send_message(self.sock, hello)
+            self.metrics.peer_bytes(self.peer, sent=sent)
+            message = protocol.recv_sized_message(self.sock)
+        except (socket.timeout, ConnectionResetError, BrokenPipeError):
+            # original nodes choke on the frame and hang up (or just hang)
+            message = None
+        if message is None:
+            raise LegacyPeer()
+
+        response, _, size = message
+        self.metrics.peer_bytes(self.peer, received=size)
+        if response.get('type') != 'hello_response':
+            # framed messages but no hello (version 1 node)
+            return protocol.JSON_FRAMING
+        return protocol.FRAMINGS.get(response.get('version'), protocol.JSON_FRAMING)
+
+    def send_request(self, request):
+        """Send a request without waiting, returns a PendingRequest"""
+        with self.pending_lock:
+            if self.closed:
+                raise ConnectionError(f"Connection to {self.peer[0]}:{self.peer[1]} is closed")
+            request_id = self.next_id
+            self.next_id += 1
+            pending = PendingRequest(request_id)
+            self.pending[request_id] = pending
+
+        message = dict(request, id=request_id)
+        try:
+            with self.send_lock:
+                sent = protocol.send_message(self.sock, message, framing=self.framing)
+        except OSError as e:
+            self.close(e)
+            raise
+        self.metrics.peer_bytes(self.peer, sent=sent)
+        return pending
+
+    def request(self, request, timeout):
+        """Send a request and wait for its response"""
+        pending = self.send_request(request)
+        try:
+            return pending.wait(timeout)
+        finally:
+            self.discard(pending)
+
+    def discard(self, pending):
+        """Forget a request (late responses get dropped)"""
+        with self.pending_lock:
+            self.pending.pop(pending.request_id, None)
+
+    def read_loop(self):
+        """Match responses to pending requests"""
+        error = ConnectionError(f"Connection to {self.peer[0]}:{self.peer[1]} closed")
+        while not self.closed:
+            try:
+                message = protocol.recv_sized_message(self.sock, self.framing)
+            except socket.timeout:
+                # idle
+                continue
+            except (OSError, ValueError) as e:
+                error = ConnectionError(f"Connection to {self.peer[0]}:{self.peer[1]} failed: {e}")
+                break
+            if message is None:
+                break
+
+            header, payload, size = message
+            self.metrics.peer_bytes(self.peer, received=size)
+            with self.pending_lock:
+                pending = self.pending.pop(header.get('id'), None)
+            if pending:
+                pending.set_result(header, payload)
+        self.close(error)
+
+    def close(self, error=None):
+        """Close the connection and fail everything still waiting"""
+        with self.pending_lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending = {}
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+        if error is None:
+            error = ConnectionError(f"Connection to {self.peer[0]}:{self.peer[1]} closed")
+        for p in pending:
+            p.set_error(error)
+
+
+class LegacyConnection:
+    """Peer that only speaks the original protocol
+
+    One bare JSON request per TCP connection, answered with bare JSON
+    (or a length-prefixed header + data for chunks) and then closed.
+    Same interface as PeerConnection so callers don't care.
+    """
+
+    version = 0
+    closed = False
+
+    def __init__(self, peer, timeout=5.0, registry=None):
+        self.peer = peer
+        self.timeout = timeout
+        self.metrics = registry or metrics.Registry(enabled=False)
+
+    def request(self, request, timeout):
+        """Send a request on a fresh connection and read the response"""
+        request = {k: v for k, v in request.items() if k != 'id'}
+        with socket.create_connection(self.peer, timeout=min(timeout, self.timeout)) as s:
+            s.settimeout(timeout)
+            request_bytes = json.dumps(request).encode('utf-8')
+            s.sendall(request_bytes)
+            self.metrics.peer_bytes(self.peer, sent=len(request_bytes))
+
+            if request.get('type') == 'chunk':
+                prefix = protocol.recv_exact(s, protocol.HEADER_SIZE_BYTES)
+                if prefix is not None and not prefix.startswith(b'{'):
+                    header_size = int.from_bytes(prefix, byteorder='big')
+                    protocol.check_size(header_size, protocol.MAX_META_SIZE, "Message header")
+                    header = protocol.decode_header(protocol.recv_exact(s, header_size))
+                    chunk_size = header.get('chunk_size', 0)
+                    if not isinstance(chunk_size, int):
+                        raise ConnectionError("Bad chunk size")
+                    protocol.check_size(chunk_size, protocol.MAX_PAYLOAD_SIZE, "Chunk")
+                    data = protocol.recv_exact(s, chunk_size)
+                    self.metrics.peer_bytes(self.peer, received=len(prefix) + header_size
+                                            + (len(data) if data else 0))
+                    return header, data
+                # an error comes back as plain JSON
+                data = bytearray(prefix or b'')
+            else:
+                data = bytearray()
+
+            # the response ends when the peer closes
+            while True:
+                part = s.recv(65536)
+                if not part:
+                    break
+                data.extend(part)
+                protocol.check_size(len(data), protocol.MAX_META_SIZE, "Response")
+        self.metrics.peer_bytes(self.peer, received=len(data))
+
+        if not data:
+            # old nodes just hang up on request types they don't know
+            return {'type': 'error', 'error': 'Unknown request type'}, None
+        return protocol.decode_header(data), None
+
+    def send_request(self, request):
+        """Run the request in a thread, returns a PendingRequest"""
+        pending = PendingRequest(None)
+
+        def run():
+            try:
+                pending.set_result(*self.request(request, self.timeout * 2))
+            except (OSError, ValueError) as e:
+                pending.set_error(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return pending
+
+    def close(self, error=None):
+        """Nothing stays open"""
+        pass
+
+
+class ConnectionPool:
+    """One persistent connection per peer, opened on first use
+
+    Peers that turn out to only speak the original protocol get a
+    LegacyConnection instead (remembered so the hello isn't retried).
+    """
+
+    def __init__(self, connect_timeout=5.0, registry=None, listen_port=None):
+        self.connect_timeout = connect_timeout
+        self.metrics = registry or metrics.Registry(enabled=False)
+        # our server's port, sent in the hello
+        self.listen_port = listen_port
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, peer):
+        """Open connection to peer (reused if still alive)"""
+        with self.lock:
+            conn = self.connections.get(peer)
+        if conn is not None and not conn.closed:
+            return conn
+
+        # connect outside the lock so a dead peer doesn't hold up the others
+        try:
+            with self.metrics.timer('connect'):
+                conn = PeerConnection(peer, self.connect_timeout, self.metrics, self.listen_port)
+        except LegacyPeer:
+            conn = LegacyConnection(peer, self.connect_timeout, self.metrics)
+        except OSError:
+            self.metrics.count('connect_failures')
+            raise
+        self.metrics.count('connects')
+        with self.lock:
+            current = self.connections.get(peer)
+            if current is not None and not current.closed:
+                # another thread won the race
+                conn.close()
+                return current
+            self.connections[peer] = conn
+        return conn
+
+    def send_request(self, peer, request):
+        """Pipelined request, returns a PendingRequest"""
+        return self.get(peer).send_request(request)
+
+    def request(self, peer, request, timeout):
+        """Send a request to peer and wait for the response"""
+        conn = self.get(peer)
+        try:
+            return conn.request(request, timeout)
+        except ConnectionError:
+            # pooled connection may have gone stale (peer closed it while idle)
+            return self.get(peer).request(request, timeout)
+
+    def close(self, peer):
+        """Close the connection to one peer"""
+        with self.lock:
+            conn = self.connections.pop(peer, None)
+        if conn:
+            conn.close()
+
+    def close_all(self):
+        """Close every connection"""
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+        for conn in connections:
+            conn.close()
@@ -0,0 +1,398 @@
+"""
+Parallel chunk downloads for P2P file sharing app
+"""
+import os
+import json
+import queue
+import threading
+import time
+import utils
+
+# Chunk requests in flight per download (per source peer)
+MAX_OUTSTANDING = 8
+# Tries per chunk (per source peer) before the download fails
+MAX_CHUNK_RETRIES = 3
+# Failed requests in a row before a source peer is dropped
+MAX_PEER_FAILURES = 3
+# A source slower than this fraction of the fastest one gets dropped...
+SLOW_PEER_RATIO = 0.2
+# ...but only after it had this many seconds to get going
+SLOW_PEER_GRACE = 3.0
+# Sidecar next to the temp file that records finished chunks
+BITFIELD_SUFFIX = '.bitfield'
+# Save the bitfield at most this often while downloading
+SAVE_INTERVAL = 1.0
+# A source that keeps us choked this long counts as failing
+MAX_CHOKED_TIME = 30.0
+# Print download progress at most this often
+PROGRESS_INTERVAL = 1.0
+
+
+class Choked(Exception):
+    """Source has no upload slot for us right now"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"choked, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class Bitfield:
+    """Which chunks of a download are written and verified
+
+    Saved next to the temp file so an interrupted download (even across
+    a restart) picks up where it left off. Tied to the file hash, merkle
+    root and chunk layout, so a bitfield for a different version of the
+    file, or chunks checked against another peer's root, are ignored.
+    """
+
+    def __init__(self, path, file_info, chunk_size):
+        self.path = path
+        self.file_hash = file_info['hash']
+        self.merkle_root = file_info.get('merkle_root')
+        self.num_chunks = file_info['num_chunks']
+        self.chunk_size = chunk_size
+        self.bits = bytearray((self.num_chunks + 7) // 8)
+
+    def has(self, i):
+        """Chunk i is done"""
+        return bool(self.bits[i // 8] & (1 << (i % 8)))
+
+    def set(self, i):
+        """Mark chunk i done"""
+        self.bits[i // 8] |= 1 << (i % 8)
+
+    def count(self):
+        """Number of chunks done"""
+        return sum(bin(b).count('1') for b in self.bits)
+
+    def load(self):
+        """Read a saved bitfield, returns False if there's none for this file"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            bits = bytearray.fromhex(data['chunks'])
+        except (OSError, ValueError, KeyError):
+            return False
+        if (data.get('hash') != self.file_hash or data.get('merkle_root') != self.merkle_root
+                or data.get('num_chunks') != self.num_chunks or data.get('chunk_size') != self.chunk_size):
+            return False
+        if len(bits) != len(self.bits):
+            return False
+        self.bits = bits
+        return True
+
+    def save(self):
+        """Write the bitfield (write then rename so it's never half written)"""
+        data = {
+            'hash': self.file_hash,
+            'merkle_root': self.merkle_root,
+            'num_chunks': self.num_chunks,
+            'chunk_size': self.chunk_size,
+            'chunks': self.bits.hex()
+        }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        """Delete the saved bitfield"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SwarmPeer:
+    """Download state for one source peer"""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.bytes = 0
+        self.chunks = 0
+        self.failures = 0
+        self.started = time.time()
+        self.in_flight = set()
+        self.dropped = False
+        self.choked_since = None
+
+    def rate(self):
+        """Bytes per second received from this peer"""
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+
+
+class OutputFile:
+    """Download target, preallocated to its final size once
+
+    Chunks are written at their offsets with pwrite on a single fd, so
+    writes can land in any order from any thread without seeking.
+    """
+
+    def __init__(self, path, size, keep=False):
+        flags = os.O_RDWR | os.O_CREAT
+        if not keep:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        self.preallocate(size)
+
+    def preallocate(self, size):
+        """Make the file exactly size bytes, reserving the blocks if we can"""
+        os.ftruncate(self.fd, size)
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError:
+                # not supported by every filesystem, ftruncate is enough
+                pass
+
+    def write(self, offset, data):
+        """Write data at offset"""
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def sync(self):
+        """Flush written chunks to disk"""
+        os.fsync(self.fd)
+
+    def close(self):
+        """Close the fd"""
+        os.close(self.fd)
+
+
+class FileDownload:
+    """Download one file with several chunk requests in flight
+
+    Every source peer gets max_outstanding worker threads. Workers pull
+    chunk indexes off one shared queue and pipeline their requests over
+    the pooled connection to their peer, so a faster peer simply ends up
+    serving more chunks. Sources that keep failing, or fall far behind
+    the fastest one, are dropped and their chunks go back on the queue
+    for the others. Chunks are written at their offsets in the temp file
+    as they arrive, in any order (see OutputFile), and recorded in a Bitfield so a
+    retried download only fetches the chunks it is missing.
+    """
+
+    def __init__(self, node, peers, filename, file_info, chunk_size, temp_path, max_outstanding=MAX_OUTSTANDING):
+        self.node = node
+        self.sources = [SwarmPeer(peer) for peer in peers]
+        self.filename = filename
+        self.file_info = file_info
+        self.temp_path = temp_path
+        self.max_outstanding = max(1, max_outstanding)
+
+        self.num_chunks = file_info['num_chunks']
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue()
+        self.retries = {}
+        self.failed = False
+        # paused or cancelled from outside, the temp file stays for a resume
+        self.stopped = False
+
+        # pick up chunks from an earlier attempt
+        self.bitfield = Bitfield(temp_path + BITFIELD_SUFFIX, file_info, chunk_size)
+        self.resumed = os.path.exists(temp_path) and self.bitfield.load()
+        if not self.resumed:
+            self.bitfield = Bitfield(temp_path + BITFIELD_SUFFIX, file_info, chunk_size)
+        self.have = [self.bitfield.has(i) for i in range(self.num_chunks)]
+        self.done = self.bitfield.count()
+        self.last_save = time.time()
+        # bytes fetched in this run (not resumed ones), for the rate
+        self.started = time.time()
+        self.received = 0
+        self.last_progress = 0.0
+
+        self.lock = threading.Lock()
+        self.out = None
+
+    def run(self):
+        """Download missing chunks into temp_path, returns True on success"""
+        for i in range(self.num_chunks):
+            if not self.have[i]:
+                self.chunks.put(i)
+        if self.resumed:
+            print(f"Resuming {self.filename}: {self.done}/{self.num_chunks} chunks already here")
+
+        self.out = OutputFile(self.temp_path, self.file_info['size'], keep=self.resumed)
+        try:
+            workers = []
+            for source in self.sources:
+                for _ in range(min(self.max_outstanding, self.num_chunks)):
+                    t = threading.Thread(target=self.worker, args=(source,), daemon=True)
+                    t.start()
+                    workers.append(t)
+            for t in workers:
+                t.join()
+            with self.lock:
+                self.save_progress()
+        finally:
+            self.out.close()
+            self.out = None
+
+        return not self.failed and self.done == self.num_chunks
+
+    def save_progress(self):
+        """Flush written chunks to disk, then record them (lock held)"""
+        self.out.sync()
+        self.bitfield.save()
+        self.last_save = time.time()
+
+    def discard(self):
+        """Throw away the temp file and its bitfield"""
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.bitfield.remove()
+
+    def finished(self):
+        """Every chunk is in, or the download failed or was stopped"""
+        return self.failed or self.stopped or self.done == self.num_chunks
+
+    def stop(self):
+        """Stop fetching chunks (run returns once in-flight requests are back)"""
+        with self.lock:
+            self.stopped = True
+
+    def progress(self):
+        """(bytes done, bytes total, bytes/s in this run, seconds left or None)"""
+        with self.lock:
+            size = self.file_info['size']
+            done_bytes = min(size, self.done * self.chunk_size)
+            elapsed = time.time() - self.started
+            rate = self.received / elapsed if elapsed > 0 else 0.0
+        eta = (size - done_bytes) / rate if rate > 0 else None
+        return done_bytes, size, rate, eta
+
+    def report_progress(self):
+        """Print percent, MB/s and ETA"""
+        done_bytes, size, rate, eta = self.progress()
+        percent = done_bytes / size * 100 if size else 100.0
+        print(f"{self.filename}: {percent:.1f}% of {size / (1024 * 1024):.1f} MB, "
+              f"{rate / (1024 * 1024):.2f} MB/s, ETA {utils.format_eta(eta)}")
+
+    def worker(self, source):
+        """Fetch chunks from one source until the download is over"""
+        while not self.finished() and not source.dropped:
+            try:
+                # chunks can be put back by other workers, so keep polling
+                i = self.chunks.get(timeout=0.2)
+            except queue.Empty:
+                continue
+
+            with self.lock:
+                if self.have[i]:
+                    continue
+                source.in_flight.add(i)
+
+            # each chunk is checked against the merkle root as it arrives
+            try:
+                chunk_data = self.node.download_chunk(source.peer, self.filename, i,
+                                                      self.file_info.get('merkle_root'),
+                                                      self.num_chunks)
+            except Choked as e:
+                with self.lock:
+                    source.in_flight.discard(i)
+                self.chunk_choked(source, i, e.retry_after)
+                continue
+
+            with self.lock:
+                source.in_flight.discard(i)
+                source.choked_since = None
+            # a source that counts chunks differently sends the wrong sizes
+            if not chunk_data or len(chunk_data) != self.chunk_length(i):
+                self.chunk_failed(source, i)
+                continue
+
+            source.failures = 0
+            self.write_chunk(source, i, chunk_data)
+            self.drop_slow_sources()
+
+    def chunk_length(self, i):
+        """Bytes in chunk i"""
+        return min(self.chunk_size, self.file_info['size'] - i * self.chunk_size)
+
+    def chunk_choked(self, source, i, retry_after):
+        """Put the chunk back for any source and wait for our turn"""
+        with self.lock:
+            now = time.time()
+            if source.choked_since is None:
+                source.choked_since = now
+            waited = now - source.choked_since
+        if waited >= MAX_CHOKED_TIME:
+            self.chunk_failed(source, i)
+            return
+        self.chunks.put(i)
+        time.sleep(min(retry_after, MAX_CHOKED_TIME))
+
+    def chunk_failed(self, source, i):
+        """Count the failure and put the chunk back for any source"""
+        with self.lock:
+            source.failures += 1
+            self.retries[i] = self.retries.get(i, 0) + 1
+            if self.retries[i] >= MAX_CHUNK_RETRIES * len(self.sources):
+                print(f"\nChunk {i} failed {self.retries[i]} times")
+                self.failed = True
+                return
+            # the last source is kept, the chunk retry limit ends it if it's dead
+            others = [s for s in self.sources if s is not source and not s.dropped]
+            if source.failures >= MAX_PEER_FAILURES and not source.dropped and others:
+                self.drop(source, f"{source.failures} failed requests in a row")
+        self.chunks.put(i)
+
+    def drop(self, source, reason):
+        """Stop using a source, its chunks get requested elsewhere (lock held)"""
+        source.dropped = True
+        print(f"\nDropping {source.peer[0]}:{source.peer[1]} ({reason})")
+        for i in source.in_flight:
+            self.chunks.put(i)
+        source.in_flight = set()
+
+        if all(s.dropped for s in self.sources):
+            print("\nNo sources left")
+            self.failed = True
+
+    def drop_slow_sources(self):
+        """Drop sources far slower than the fastest one"""
+        with self.lock:
+            active = [s for s in self.sources if not s.dropped]
+            if len(active) < 2:
+                return
+            best = max(s.rate() for s in active)
+            now = time.time()
+            for s in active:
+                if now - s.started < SLOW_PEER_GRACE:
+                    continue
+                if s.rate() < best * SLOW_PEER_RATIO:
+                    self.drop(s, f"{s.rate() / 1024:.1f} KB/s, fastest {best / 1024:.1f} KB/s")
+
+    def write_chunk(self, source, i, chunk_data):
+        """Write chunk at its offset"""
+        # a dropped source can still deliver a chunk someone else already got
+        with self.lock:
+            if self.have[i]:
+                return
+
+        # no lock needed for the write itself, chunks never overlap
+        with self.node.metrics.timer('disk_write'):
+            self.out.write(i * self.chunk_size, chunk_data)
+
+        with self.lock:
+            if self.have[i]:
+                return
+            self.have[i] = True
+            self.bitfield.set(i)
+            if time.time() - self.last_save >= SAVE_INTERVAL:
+                self.save_progress()
+            self.done += 1
+            self.received += len(chunk_data)
+            source.bytes += len(chunk_data)
+            source.chunks += 1
+            # one line a second, not one per chunk
+            now = time.time()
+            report = self.done == self.num_chunks or now - self.last_progress >= PROGRESS_INTERVAL
+            if report:
+                self.last_progress = now
+        if report:
+            self.report_progress()
@@ -0,0 +1,233 @@
+"""
+Download queue for P2P file sharing app
+"""
+import heapq
+import threading
+
+# Downloads running at once (the rest wait in the queue)
+MAX_ACTIVE = 2
+# Finished, failed and cancelled downloads kept in the list
+HISTORY = 50
+
+QUEUED = 'queued'
+ACTIVE = 'active'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+# States a download doesn't leave on its own
+FINAL = (DONE, CANCELLED)
+
+# Priority names, lower runs first
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+PRIORITY_NAMES = {level: name for name, level in PRIORITIES.items()}
+
+
+class DownloadJob:
+    """One download in the queue"""
+
+    def __init__(self, job_id, peer, filename, swarm, priority):
+        self.id = job_id
+        self.peer = peer
+        self.filename = filename
+        self.swarm = swarm
+        self.priority = priority
+        self.state = QUEUED
+        self.error = None
+        # FileDownload while active, and what to become when it stops early
+        self.transfer = None
+        self.stop_as = None
+        self.lock = threading.Lock()
+
+    def attach(self, transfer):
+        """The job's FileDownload was created (stopped at once if it's too late)"""
+        with self.lock:
+            self.transfer = transfer
+            stop = self.stop_as is not None
+        if stop:
+            transfer.stop()
+
+    def stop(self, state):
+        """Stop the running download, it ends up in state"""
+        with self.lock:
+            self.stop_as = state
+            transfer = self.transfer
+        if transfer is not None:
+            transfer.stop()
+
+    def progress(self):
+        """FileDownload.progress() while chunks are coming in, else None"""
+        with self.lock:
+            transfer = self.transfer
+        return transfer.progress() if transfer is not None else None
+
+
+class DownloadManager:
+    """Runs queued downloads, at most max_active at a time
+
+    Jobs start in priority order (then in the order they were added).
+    Pausing stops a running download but keeps its temp file and
+    bitfield, so resuming only fetches the missing chunks; cancelling
+    throws them away.
+    """
+
+    def __init__(self, node, max_active=MAX_ACTIVE):
+        self.node = node
+        self.max_active = max(1, max_active)
+        self.jobs = {}  # id -> DownloadJob, oldest first
+        self.heap = []  # (priority, seq, id)
+        self.seq = 0
+        self.next_id = 1
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def push(self, job):
+        """Add a heap entry for a queued job (lock held)"""
+        self.seq += 1
+        heapq.heappush(self.heap, (job.priority, self.seq, job.id))
+
+    def add(self, peer, filename, swarm=False, priority=PRIORITIES['normal']):
+        """Queue a download, returns the job (None if filename is already queued)"""
+        with self.lock:
+            for job in self.jobs.values():
+                # same temp file, they'd trample each other
+                if job.filename == filename and job.state not in FINAL:
+                    return None
+            job = DownloadJob(self.next_id, peer, filename, swarm, priority)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.push(job)
+        self.schedule()
+        return job
+
+    def schedule(self):
+        """Start queued jobs while there are free slots"""
+        with self.lock:
+            while self.active < self.max_active and self.heap:
+                priority, _, job_id = heapq.heappop(self.heap)
+                job = self.jobs.get(job_id)
+                # paused, cancelled or re-prioritised since it was pushed
+                if job is None or job.state != QUEUED or job.priority != priority:
+                    continue
+                job.state = ACTIVE
+                job.stop_as = None
+                job.error = None
+                self.active += 1
+                threading.Thread(target=self.run_job, args=(job,), daemon=True).start()
+
+    def run_job(self, job):
+        """Run one download (own thread)"""
+        ok = False
+        try:
+            ok = self.node.download_file(job.peer, job.filename, job.swarm, job=job)
+        except (OSError, ValueError) as e:
+            job.error = str(e) or type(e).__name__
+        finally:
+            # whatever went wrong, the slot is given back
+            self.finish(job, ok)
+
+    def finish(self, job, ok):
+        """Record how a job ended, free its slot and start the next one"""
+        with self.lock:
+            self.active -= 1
+            with job.lock:
+                job.transfer = None
+                stop_as = job.stop_as
+            if ok:
+                # finished before the stop got to it
+                job.state = DONE
+            elif stop_as is not None:
+                job.state = stop_as
+            else:
+                job.state = FAILED
+            self.prune()
+        if job.state == CANCELLED:
+            self.node.discard_download(job.filename)
+        reason = f" ({job.error})" if job.error else ""
+        print(f"\nDownload #{job.id} {job.filename}: {job.state}{reason}")
+        self.schedule()
+
+    def prune(self):
+        """Forget the oldest finished jobs past HISTORY (lock held)"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.state in FINAL]
+        for job_id in finished[:max(0, len(finished) - HISTORY)]:
+            del self.jobs[job_id]
+
+    def pause(self, job_id):
+        """Pause a queued or running download, returns False if it can't be"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            if job.state == QUEUED:
+                job.state = PAUSED
+                return True
+            if job.state == ACTIVE:
+                job.stop(PAUSED)
+                return True
+            return False
+
+    def resume(self, job_id):
+        """Queue a paused or failed download again, returns False if it can't be"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in (PAUSED, FAILED):
+                return False
+            job.state = QUEUED
+            self.push(job)
+        self.schedule()
+        return True
+
+    def cancel(self, job_id):
+        """Cancel a download and delete what it fetched, returns False if it can't be"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.state in FINAL:
+                return False
+            if job.state == ACTIVE:
+                # run_job cleans up once the transfer is stopped
+                job.stop(CANCELLED)
+                return True
+            job.state = CANCELLED
+            self.prune()
+        self.node.discard_download(job.filename)
+        return True
+
+    def set_priority(self, job_id, priority):
+        """Change the priority of a download that hasn't started, returns False if it can't be"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in (QUEUED, PAUSED):
+                return False
+            job.priority = priority
+            if job.state == QUEUED:
+                # the old heap entry gets skipped
+                self.push(job)
+        self.schedule()
+        return True
+
+    def stop(self):
+        """Pause every running download (their progress is saved)"""
+        with self.lock:
+            for job in self.jobs.values():
+                if job.state == ACTIVE:
+                    job.stop(PAUSED)
+
+    def snapshot(self):
+        """Every job as a dict (for display), oldest first"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        listed = []
+        for job in jobs:
+            item = {
+                'id': job.id,
+                'filename': job.filename,
+                'peer': job.peer,
+                'swarm': job.swarm,
+                'priority': PRIORITY_NAMES.get(job.priority, str(job.priority)),
+                'state': job.state,
+                'error': job.error,
+                'progress': job.progress()
+            }
+            listed.append(item)
+        return listed
@@ -0,0 +1,282 @@
+"""
+File index helpers for P2P file sharing app
+"""
+import os
+import json
+import time
+import heapq
+import types
+import threading
+import contextlib
+import search_index
+
+# Metadata cache lives in the shared dir (dot file so it's never shared)
+CACHE_FILENAME = '.p2p_index.json'
+# Bump when the cached metadata format changes
+CACHE_VERSION = 3
+
+
+class IndexSnapshot:
+    """Immutable, versioned view of the shared files
+
+    The node swaps in a whole new snapshot when a rebuild finishes, so
+    readers grab the current one without locking and never see a half
+    built index. File info dicts inside must not be modified.
+    """
+
+    def __init__(self, version, files):
+        self.version = version
+        self.files = types.MappingProxyType(dict(files))
+
+
+class HashCache:
+    """On-disk file metadata cache
+
+    Entries are keyed by (inode, size, mtime_ns), so a file is only
+    hashed again when it is new or has changed since it was cached.
+    """
+
+    def __init__(self, shared_dir):
+        self.path = os.path.join(shared_dir, CACHE_FILENAME)
+        self.entries = {}  # filename -> {'key': [...], 'info': {...}}
+        self.dirty = False
+        # one save at a time, so an older copy never overwrites a newer one
+        self.save_lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def file_key(st):
+        """Cache key from os.stat result"""
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def load(self):
+        """Read the cache from disk (missing or broken cache = empty)"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != CACHE_VERSION:
+            return
+        self.entries = data.get('files', {})
+
+    def lookup(self, filename, st):
+        """Cached info for filename, None if missing or stale"""
+        entry = self.entries.get(filename)
+        if entry is None or entry['key'] != self.file_key(st):
+            return None
+        return entry['info']
+
+    def store(self, filename, st, info):
+        """Remember info for filename as of stat result st"""
+        self.entries[filename] = {
+            'key': self.file_key(st),
+            'info': info
+        }
+        self.dirty = True
+
+    def prune(self, filenames):
+        """Drop entries for files that are gone"""
+        for filename in list(self.entries):
+            if filename not in filenames:
+                del self.entries[filename]
+                self.dirty = True
+
+    def save(self, lock=None):
+        """Write the cache to disk if it changed
+
+        lock (the one guarding the entries) is only held while they are
+        copied, a big cache takes a while to write.
+        """
+        with self.save_lock:
+            with lock or contextlib.nullcontext():
+                if not self.dirty:
+                    return
+                data = {
+                    'version': CACHE_VERSION,
+                    'files': dict(self.entries)
+                }
+                self.dirty = False
+            # write then rename so a crash never leaves a half written cache
+            temp_path = self.path + '.tmp'
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump(data, f)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print(f"Could not save index cache: {e}")
+                self.dirty = True
+
+
+class HashQueue:
+    """Files waiting to be hashed in the background
+
+    Files are hashed in the order they were found, except that a file a
+    peer asks for jumps to the front (bump). Each entry remembers the
+    stat key it was queued with, so a file that changes while it is
+    being hashed is queued again instead of getting stale info.
+    """
+
+    URGENT = 0
+    NORMAL = 1
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []           # (priority, seq, filename)
+        self.pending = {}        # filename -> os.stat result it was queued with
+        self.in_progress = set()
+        self.seq = 0
+        # progress of the current batch (reset when the queue drains)
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        self.started = None
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending)
+
+    def __contains__(self, filename):
+        with self.cond:
+            return filename in self.pending
+
+    def push(self, priority, filename):
+        """Add a heap entry (cond held)"""
+        self.seq += 1
+        heapq.heappush(self.heap, (priority, self.seq, filename))
+        self.cond.notify()
+
+    @staticmethod
+    def same(a, b):
+        """Two stat results of an unchanged file"""
+        return HashCache.file_key(a) == HashCache.file_key(b)
+
+    def put(self, filename, st):
+        """Queue filename as of stat result st (no-op if already queued as is)"""
+        with self.cond:
+            entry = self.pending.get(filename)
+            if entry is not None and self.same(entry, st):
+                return
+            if not self.pending:
+                self.total_files = self.total_bytes = 0
+                self.done_files = self.done_bytes = 0
+                self.started = time.time()
+            if entry is None:
+                self.total_files += 1
+            else:
+                self.total_bytes -= entry.st_size
+            self.total_bytes += st.st_size
+            self.pending[filename] = st
+            self.push(self.NORMAL, filename)
+
+    def bump(self, filename):
+        """Hash filename next (if it's waiting)"""
+        with self.cond:
+            if filename in self.pending and filename not in self.in_progress:
+                self.push(self.URGENT, filename)
+
+    def keep(self, filenames):
+        """Forget queued files that are no longer shared"""
+        with self.cond:
+            for filename in list(self.pending):
+                if filename not in filenames:
+                    self.total_files -= 1
+                    self.total_bytes -= self.pending.pop(filename).st_size
+            self.cond.notify_all()
+
+    def get(self, timeout):
+        """Next (filename, stat result) to hash, None if nothing came up in time"""
+        with self.cond:
+            end = time.time() + timeout
+            while True:
+                while self.heap:
+                    _, _, filename = heapq.heappop(self.heap)
+                    # bumped files leave a second entry behind, skip it
+                    if filename in self.pending and filename not in self.in_progress:
+                        self.in_progress.add(filename)
+                        return filename, self.pending[filename]
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def done(self, filename, st):
+        """Hashing filename finished, returns False if the result is stale"""
+        with self.cond:
+            self.in_progress.discard(filename)
+            entry = self.pending.get(filename)
+            if entry is None:
+                # no longer shared
+                return False
+            if not self.same(entry, st):
+                # changed while we hashed it, do it again
+                self.push(self.NORMAL, filename)
+                return False
+            del self.pending[filename]
+            self.done_files += 1
+            self.done_bytes += entry.st_size
+            self.cond.notify_all()
+            return True
+
+    def failed(self, filename):
+        """Hashing filename failed (it went away), give up on it"""
+        with self.cond:
+            self.in_progress.discard(filename)
+            entry = self.pending.pop(filename, None)
+            if entry is not None:
+                self.total_files -= 1
+                self.total_bytes -= entry.st_size
+            self.cond.notify_all()
+
+    def wait(self, filename, timeout):
+        """Wait until filename isn't queued any more, returns False on timeout"""
+        with self.cond:
+            return self.cond.wait_for(lambda: filename not in self.pending, timeout)
+
+    def progress(self):
+        """(files done, files total, bytes done, bytes total, seconds) of this batch"""
+        with self.cond:
+            elapsed = time.time() - self.started if self.started else 0.0
+            return (self.done_files, self.total_files, self.done_bytes, self.total_bytes, elapsed)
+
+
+class RemoteIndex:
+    """Cached copy of a peer's file list, kept current with delta syncs
+
+    Holds the peer's epoch and generation so the next sync only asks
+    for what changed since then. Searches run against the local copy.
+    """
+
+    def __init__(self):
+        self.epoch = None
+        self.generation = None
+        self.files = {}  # filename -> public file info
+        self.search_index = search_index.SearchIndex()
+        self.lock = threading.Lock()
+
+    def apply(self, response):
+        """Apply a list response (full list or changes), False if it was stale"""
+        with self.lock:
+            if response.get('full'):
+                self.files = dict(response.get('added', {}))
+                self.search_index.update(self.files)
+            elif response.get('epoch') != self.epoch or response.get('since') != self.generation:
+                # changes against a version we no longer have (another sync won)
+                return False
+            else:
+                for filename in response.get('removed', []):
+                    self.files.pop(filename, None)
+                    self.search_index.remove(filename)
+                for filename, info in response.get('added', {}).items():
+                    self.files[filename] = info
+                    self.search_index.add(filename)
+            self.epoch = response.get('epoch')
+            self.generation = response.get('generation')
+            return True
+
+    def search(self, query):
+        """Cached files matching query, best first"""
+        with self.lock:
+            return [dict(self.files[filename], filename=filename)
+                    for filename in self.search_index.search(query)]
@@ -10,10 +10,38 @@ def main():
     # https://docs.python.org/3/library/argparse.html
     parser = argparse.ArgumentParser(description="P2P")
     parser.add_argument("--dir", default="./shared", help="Dir to share from")
+    parser.add_argument("--outstanding", type=int, default=N.download.MAX_OUTSTANDING,
+                        help="Chunk requests in flight per download")
+    parser.add_argument("--server", choices=["thread", "asyncio"], default="thread",
+                        help="Thread per connection or a single asyncio event loop")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=N.compression.DEFAULT_LEVEL,
+                        metavar="0-9", help="zlib level for chunks sent to peers (0 = off)")
+    parser.add_argument("--hash-workers", type=int, default=N.HASH_WORKERS,
+                        help="Files hashed in parallel in the background")
+    parser.add_argument("--chunk-cache", type=int, default=N.upload.CHUNK_CACHE_SIZE // (1024 * 1024),
+                        help="MB of recently served chunks kept in memory (0 = off)")
+    parser.add_argument("--upload-slots", type=int, default=N.upload.UPLOAD_SLOTS,
+                        help="Peers uploaded to at once (the rest wait their turn)")
+    parser.add_argument("--upload-rate", type=int, default=0,
+                        help="Upload limit per peer in KB/s (0 = no limit)")
+    parser.add_argument("--max-upload-rate", type=int, default=0,
+                        help="Total upload limit in KB/s (0 = no limit)")
+    parser.add_argument("--max-downloads", type=int, default=N.download_queue.MAX_ACTIVE,
+                        help="Downloads running at once (the rest wait in the queue)")
+    parser.add_argument("--no-metrics", action="store_true",
+                        help="Don't collect counters and latencies")
+    parser.add_argument("--metrics-file",
+                        help="Write metrics as JSON to this file every 15s")
     
     args = parser.parse_args()
     
-    node = N.P2PNode(args.dir)
+    node = N.P2PNode(args.dir, max_outstanding=args.outstanding, server_mode=args.server,
+                     compress_level=args.compress_level, hash_workers=args.hash_workers,
+                     chunk_cache_size=args.chunk_cache * 1024 * 1024,
+                     upload_slots=args.upload_slots, upload_rate=args.upload_rate * 1024,
+                     max_upload_rate=args.max_upload_rate * 1024,
+                     metrics_enabled=not args.no_metrics, metrics_file=args.metrics_file,
+                     max_downloads=args.max_downloads)
     cli = C.CommandLine(node)
     cli.start()
 
@@ -0,0 +1,102 @@
+"""
+Merkle tree over file chunks for P2P file sharing app
+"""
+import hashlib
+
+# Leaves and inner nodes are hashed with different prefixes so one
+# can't be passed off as the other
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def hash_leaf(data):
+    """Leaf hash of one chunk (bytes or memoryview, never copied)"""
+    h = hashlib.sha256(LEAF_PREFIX)
+    h.update(data)
+    return h.digest()
+
+
+def hash_node(left, right):
+    """Hash of two child hashes"""
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+class MerkleTree:
+    """Merkle tree built from a file's chunk (leaf) hashes
+
+    An odd node at the end of a level is carried up unchanged.
+    """
+
+    def __init__(self, leaves):
+        self.levels = [list(leaves)]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            parents = []
+            for i in range(0, len(level), 2):
+                if i + 1 < len(level):
+                    parents.append(hash_node(level[i], level[i + 1]))
+                else:
+                    parents.append(level[i])
+            self.levels.append(parents)
+
+    def root(self):
+        """Root hash (hex), the hash of nothing for an empty file"""
+        if not self.levels[0]:
+            return hashlib.sha256(b'').hexdigest()
+        return self.levels[-1][0].hex()
+
+    def proof(self, index):
+        """Sibling hashes from leaf index up to the root
+
+        Returns a list of [side, hex hash] where side says whether the
+        sibling goes on the left ('L') or right ('R').
+        """
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                side = 'L' if sibling < index else 'R'
+                proof.append([side, level[sibling].hex()])
+            index //= 2
+        return proof
+
+
+def proof_sides(index, num_leaves):
+    """Sides of the siblings on the way up from leaf index ('L' or 'R')
+
+    Worked out from the tree shape alone, so a proof for another leaf
+    can't be passed off as one for this leaf.
+    """
+    sides = []
+    count = num_leaves
+    while count > 1:
+        sibling = index ^ 1
+        if sibling < count:
+            sides.append('L' if sibling < index else 'R')
+        index //= 2
+        count = (count + 1) // 2
+    return sides
+
+
+def verify_chunk(data, proof, root, index, num_leaves):
+    """Check chunk index against the root using its proof
+
+    Only the sibling hashes are taken from the proof, the sides come
+    from index and num_leaves.
+    """
+    if not 0 <= index < num_leaves:
+        return False
+    sides = proof_sides(index, num_leaves)
+    if len(proof) != len(sides):
+        return False
+    h = hash_leaf(data)
+    for side, step in zip(sides, proof):
+        try:
+            sibling = bytes.fromhex(step[1])
+        except (TypeError, ValueError, IndexError):
+            return False
+        if side == 'L':
+            h = hash_node(sibling, h)
+        else:
+            h = hash_node(h, sibling)
+    return h.hex() == root
@@ -0,0 +1,159 @@
+"""
+Metrics (counters, latency histograms, bytes per peer) for P2P file sharing app
+"""
+import os
+import json
+import time
+import threading
+
+# Histogram bucket upper bounds in seconds: 10us doubling up to ~80s
+BUCKETS = [0.00001 * 2 ** i for i in range(24)]
+
+
+class Histogram:
+    """Latency distribution in fixed exponential buckets"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Add one sample (registry lock held)"""
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th sample (0 < q <= 1)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        """count, avg, p50, p90, p99 and max (seconds)"""
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max
+        }
+
+
+class Timer:
+    """Times a with block into a histogram"""
+
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer:
+    """Timer that does nothing (metrics off)"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Registry:
+    """Counters, latency histograms and bytes in/out per peer
+
+    Every hook checks enabled first, so with metrics off a timed block
+    costs one attribute check and a no-op context manager.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}    # name -> int
+        self.histograms = {}  # name -> Histogram
+        self.peers = {}       # "ip:port" -> [bytes in, bytes out]
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        """Add n to a counter"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """Add a latency sample"""
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name):
+        """Context manager timing its block into histogram name"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def peer_bytes(self, peer, received=0, sent=0):
+        """Count bytes exchanged with a peer"""
+        if not self.enabled or peer is None:
+            return
+        key = f"{peer[0]}:{peer[1]}"
+        with self.lock:
+            totals = self.peers.get(key)
+            if totals is None:
+                totals = self.peers[key] = [0, 0]
+            totals[0] += received
+            totals[1] += sent
+
+    def snapshot(self):
+        """Everything as a JSON-able dict"""
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'latency': {name: h.summary() for name, h in self.histograms.items()},
+                'peers': {peer: {'in': b[0], 'out': b[1]} for peer, b in self.peers.items()}
+            }
+
+    def dump(self, path, extra=None):
+        """Write the snapshot as JSON (write then rename, safe to scrape)"""
+        data = self.snapshot()
+        if extra:
+            data.update(extra)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, path)
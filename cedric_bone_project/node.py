@@ -6,38 +6,165 @@ import socket
 import threading
 import json
 import time
+import queue
+import collections
 import hashlib
 import utils
 import math
+import protocol
+import connection
+import download
+import file_index
+import merkle
+import upload
+import async_server
+import search_index
+import compression
+import peer_stats
+import metrics
+import download_queue
 
 # 64KB chunk size 
+# (smallest per-file chunk size, and what peers that don't send one use)
 CHUNK_SIZE = 64 * 1024  
 
+# Bigger files get bigger chunks, about this many per file...
+TARGET_CHUNKS = 1024
+
+# ...but never more than this per chunk
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# Close peer connections that have been idle this long
+IDLE_TIMEOUT = 60.0
+
+# Searches stop waiting for peers after this many seconds
+SEARCH_DEADLINE = 3.0
+
+# File info sent to peers (chunk hashes stay local, proofs go with chunks)
+INFO_FIELDS = ('size', 'hash', 'num_chunks', 'merkle_root', 'chunk_size')
+
+# Index changes remembered for delta list syncs (older = full list)
+CHANGE_LOG_SIZE = 64
+
+# List syncs carrying more files than this aren't sent, the peer asks us
+# to search instead (keeps them well under protocol.MAX_META_SIZE)
+MAX_SYNC_FILES = 20000
+
+# Files hashed at once in the background (hashlib drops the GIL on big updates)
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+# Put hashed files in the index at most this often (batched)
+PUBLISH_INTERVAL = 1.0
+
+# Info and chunk requests wait this long for their file to be hashed
+# (well under the 5s clients give an info request)
+HASH_WAIT = 2.0
+
+# Times an info request is repeated while the peer is still hashing the file
+HASH_RETRIES = 5
+
+# Read size when hashing, a whole number of chunks of any size
+HASH_BUFFER_SIZE = max(16 * CHUNK_SIZE, MAX_CHUNK_SIZE)
+
+# Print hashing progress at most this often
+PROGRESS_INTERVAL = 1.0
+
+# Request types served to peers (each gets a serve.<type> latency)
+SERVED_TYPES = ('list', 'info', 'chunk', 'search')
+
+
+def choose_chunk_size(size):
+    """Chunk size for a file of size bytes (a power of two times CHUNK_SIZE)"""
+    chunk_size = CHUNK_SIZE
+    while chunk_size < MAX_CHUNK_SIZE and size > chunk_size * TARGET_CHUNKS:
+        chunk_size *= 2
+    return chunk_size
+
+
 class P2PNode:
     """Modded simple version P2P file sharing from BitTorrent"""
     
-    def __init__(self, shared_dir):
+    def __init__(self, shared_dir, max_outstanding=download.MAX_OUTSTANDING, server_mode='thread',
+                 compress_level=compression.DEFAULT_LEVEL, hash_workers=HASH_WORKERS,
+                 chunk_cache_size=upload.CHUNK_CACHE_SIZE, upload_slots=upload.UPLOAD_SLOTS,
+                 upload_rate=0, max_upload_rate=0, metrics_enabled=True, metrics_file=None,
+                 max_downloads=download_queue.MAX_ACTIVE):
         """Init P2P node"""
         self.shared_dir = shared_dir
+        # chunk requests in flight per download
+        self.max_outstanding = max_outstanding
+        # 'thread' (thread per connection) or 'asyncio' (one event loop)
+        self.server_mode = server_mode
+        # zlib level for chunks sent to peers that accept it (0 = off)
+        self.compress_level = compress_level
+        # files hashed in parallel in the background
+        self.hash_workers = max(1, hash_workers)
         os.makedirs(self.shared_dir, exist_ok=True)
         self.port = utils.find_free_port()
         
         # peer tracking (manually)
         self.peers = []  # (ip, port)
-        self.files = {} 
-        # print(self.files)]
+        # RTT, throughput, failures and backoff per peer
+        self.peer_stats = peer_stats.PeerTracker()
+        # counters, latencies and bytes per peer (dumped to metrics_file if set)
+        self.metrics = metrics.Registry(metrics_enabled)
+        self.metrics_file = metrics_file
+        # current index snapshot (replaced as a whole, never modified)
+        self.index = file_index.IndexSnapshot(0, {})
+        # (version, added, removed) per snapshot, for delta list syncs.
+        # epoch changes every run so peers never mix up our versions
+        self.index_changes = collections.deque(maxlen=CHANGE_LOG_SIZE)
+        self.epoch = os.urandom(8).hex()
+        # cached file lists of peers, kept up to date with delta syncs
+        self.peer_lists = {}  # peer -> file_index.RemoteIndex
+        # peers whose list broke the frame limit, searched instead of synced
+        self.unsynced_peers = set()
+        # merkle trees of served files, built on first chunk request
+        self.merkle_trees = {}  # merkle root -> MerkleTree
+        # whether served files are worth compressing, sampled on first chunk request
+        self.compressible = {}  # file hash -> bool
+        # open fds of served files (for sendfile)
+        self.file_handles = upload.FileHandleCache()
+        # recently served chunks (popular files are served from memory)
+        self.chunk_cache = upload.ChunkCache(chunk_cache_size)
+        # upload slots (choke/unchoke) and bandwidth limits in bytes/s
+        self.uploads = upload.UploadScheduler(upload_slots, upload_rate, max_upload_rate)
+        # trigram/token index over shared filenames
+        self.search_index = search_index.SearchIndex()
+        # hashes from previous runs (only new/changed files get hashed)
+        self.hash_cache = file_index.HashCache(self.shared_dir)
+        # files listed but not hashed yet, and hashed ones not yet published
+        self.hash_queue = file_index.HashQueue()
+        self.hashed = {}  # filename -> file info
+        self.last_publish = 0.0
+        self.last_report = 0.0
 
-        # lock for conflict
+        # lock for conflict (one index rebuild at a time, readers don't take it)
         self.lock = threading.Lock()
         self.running = False
+
+        # persistent connections to peers (one per peer)
+        self.pool = connection.ConnectionPool(registry=self.metrics)
+        # queued downloads, max_downloads of them at a time
+        self.downloads = download_queue.DownloadManager(self, max_downloads)
     
     def start(self):
         """Start P2P node"""
         self.running = True
+        # peers count our traffic under the port we listen on
+        self.pool.listen_port = self.port
+        # hashing happens in the background, the index lists every file
+        # by name and size right away and the server starts at once
+        for _ in range(self.hash_workers):
+            threading.Thread(target=self.hash_worker, daemon=True).start()
         self.index_files()
         
         # tasks concurrently
-        self.server_thread = threading.Thread(target=self.run_server)
+        if self.server_mode == 'asyncio':
+            server = async_server.AsyncServer(self, IDLE_TIMEOUT, HASH_WAIT)
+            self.server_thread = threading.Thread(target=server.run)
+        else:
+            self.server_thread = threading.Thread(target=self.run_server)
         self.server_thread.daemon = True
         #print("Here")
         self.server_thread.start()
@@ -51,47 +178,264 @@ class P2PNode:
         """Stop P2P node"""
         self.running = False
         #print("STOPPING")
+        self.downloads.stop()
+        self.pool.close_all()
+        self.file_handles.close_all()
+        self.chunk_cache.clear()
         time.sleep(1)
+        self.hash_cache.save(self.lock)
+    
+    @property
+    def files(self):
+        """Files in the current index snapshot (read only)"""
+        return self.index.files
     
     def index_files(self):
-        """Index files indirectory"""
-        with self.lock:
-            self.files = {}
+        """Index files indirectory
+        
+        Only lists and stats the files, so it's quick however big the
+        share is. Files the hash cache doesn't cover are published with
+        just their size and queued for the hash workers.
+        """
+        with self.lock, self.metrics.timer('index_rebuild'):
+            files = {}
             for file_path in os.listdir(self.shared_dir):
-                if os.path.isfile(os.path.join(self.shared_dir, file_path)) and not file_path.startswith('.'):
+                full_path = os.path.join(self.shared_dir, file_path)
+                if not os.path.isfile(full_path) or file_path.startswith('.'):
+                    continue
+                
+                # stat before hashing so a change mid-hash is caught next time
+                st = os.stat(full_path)
+                file_info = self.hash_cache.lookup(file_path, st)
+                if file_info is None:
+                    self.hash_queue.put(file_path, st)
+                    file_info = {'size': st.st_size}
+                files[file_path] = file_info
+            
+            self.hash_queue.keep(files)
+            self.hash_cache.prune(files)
+            
+            self.publish_index(files)
+            print(f"Indexed {len(files)} files ({len(self.hash_queue)} waiting to be hashed)")
+        self.hash_cache.save(self.lock)
+    
+    def hash_worker(self):
+        """Hash queued files in the background"""
+        while self.running:
+            item = self.hash_queue.get(timeout=0.5)
+            if item is None:
+                continue
+            file_path, st = item
+            try:
+                with self.metrics.timer('hash_file'):
                     file_info = self.get_file_info(file_path)
-                    self.files[file_path] = file_info
-            print(f"Indexed {len(self.files)} files")
+            except OSError:
+                # gone, the next index run drops it
+                self.hash_queue.failed(file_path)
+                continue
+            
+            self.metrics.count('files_hashed')
+            self.metrics.count('bytes_hashed', file_info['size'])
+            with self.lock:
+                if not self.hash_queue.done(file_path, st):
+                    continue
+                self.hash_cache.store(file_path, st, file_info)
+                self.hashed[file_path] = file_info
+                # batched so a big share doesn't make a snapshot per file
+                drained = not len(self.hash_queue)
+                if drained or time.time() - self.last_publish >= PUBLISH_INTERVAL:
+                    self.publish_hashed()
+                self.report_hashing()
+            # the cache is saved by index_files, and once a batch is done
+            if drained:
+                self.hash_cache.save(self.lock)
+    
+    def publish_hashed(self):
+        """Swap hashed files' full info into the index (self.lock held)"""
+        if not self.hashed:
+            return
+        files = dict(self.index.files)
+        for file_path, file_info in self.hashed.items():
+            if file_path in files:
+                files[file_path] = file_info
+        self.hashed = {}
+        self.publish_index(files)
+        # stamped after, so a slow publish still leaves PUBLISH_INTERVAL to batch in
+        self.last_publish = time.time()
+    
+    def report_hashing(self):
+        """Print hashing progress now and then, and a summary at the end"""
+        done, total, done_bytes, total_bytes, elapsed = self.hash_queue.progress()
+        now = time.time()
+        rate = done_bytes / max(elapsed, 1e-6) / (1024 * 1024)
+        if done == total:
+            print(f"Hashed {done} files, {done_bytes / (1024 * 1024):.1f} MB in {elapsed:.2f}s "
+                  f"({rate:.1f} MB/s, {self.hash_workers} workers)")
+        elif now - self.last_report >= PROGRESS_INTERVAL:
+            print(f"Hashing {done}/{total} files, "
+                  f"{done_bytes / (1024 * 1024):.1f}/{total_bytes / (1024 * 1024):.1f} MB ({rate:.1f} MB/s)")
+        else:
+            return
+        self.last_report = now
+    
+    def wait_for_hash(self, filename):
+        """Info of a shared file, hashed first (jumping the queue) if it isn't yet"""
+        file_info = self.index.files.get(filename)
+        if file_info is None or 'hash' in file_info:
+            return file_info
+        self.hash_queue.bump(filename)
+        self.hash_queue.wait(filename, HASH_WAIT)
+        with self.lock:
+            self.publish_hashed()
+        return self.index.files.get(filename)
+    
+    def publish_index(self, files):
+        """Swap in a new snapshot if files changed (self.lock held)"""
+        current = self.index
+        if files == dict(current.files):
+            return
+        
+        version = current.version + 1
+        added = {}
+        removed = []
+        for filename, info in files.items():
+            if current.files.get(filename) != info:
+                added[filename] = self.public_info(info)
+        for filename in current.files:
+            if filename not in files:
+                removed.append(filename)
+        # logged first so the log always covers the published version
+        self.index_changes.append((version, added, removed))
+        self.index = file_index.IndexSnapshot(version, files)
+        
+        for filename in removed + list(added):
+            self.file_handles.invalidate(filename)
+            self.chunk_cache.invalidate(filename)
+        self.search_index.update(files)
+        roots = set(info.get('merkle_root') for info in files.values())
+        for root in list(self.merkle_trees):
+            if root not in roots:
+                self.merkle_trees.pop(root, None)
+        hashes = set(info.get('hash') for info in files.values())
+        for file_hash in list(self.compressible):
+            if file_hash not in hashes:
+                self.compressible.pop(file_hash, None)
+    
+    @staticmethod
+    def public_info(file_info):
+        """The part of file info that gets sent to peers (just size until it's hashed)"""
+        return {k: file_info[k] for k in INFO_FIELDS if k in file_info}
+    
+    @staticmethod
+    def fixed_chunk_info(info):
+        """Public info for a peer that only knows CHUNK_SIZE chunks
+        
+        Chunk counts are given in CHUNK_SIZE chunks. The merkle root is
+        left out if the file uses other chunks (no proofs fit them).
+        """
+        info = dict(info)
+        chunk_size = info.pop('chunk_size', CHUNK_SIZE)
+        if chunk_size != CHUNK_SIZE:
+            info['num_chunks'] = math.ceil(info['size'] / CHUNK_SIZE)
+            info.pop('merkle_root', None)
+        return info
+    
+    def changes_since(self, since, version):
+        """Merged (added, removed) from version since up to version, None if too old"""
+        if since == version:
+            return {}, []
+        log = [entry for entry in self.index_changes if since < entry[0] <= version]
+        if not log or log[0][0] != since + 1 or log[-1][0] != version:
+            return None
+        
+        added = {}
+        removed = set()
+        for _, entry_added, entry_removed in log:
+            for filename in entry_removed:
+                added.pop(filename, None)
+                removed.add(filename)
+            for filename, info in entry_added.items():
+                removed.discard(filename)
+                added[filename] = info
+        return added, list(removed)
     
     def get_file_info(self, file_path):
         """File metadata"""
         file_path_full = os.path.join(self.shared_dir, file_path)
         size = os.path.getsize(file_path_full)
+        chunk_size = choose_chunk_size(size)
         if size > 0:
-            num_chunks = math.ceil(size / CHUNK_SIZE)
+            num_chunks = math.ceil(size / chunk_size)
         else:
             num_chunks = 0
         
-        # Calc file hash
+        # Calc file hash and per chunk hashes in one pass, reading many
+        # chunks at a time into one reused buffer
         file_hash = hashlib.sha256()
-        with open(file_path_full, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                file_hash.update(chunk)
+        chunk_hashes = []
+        buf = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buf)
+        with open(file_path_full, 'rb', buffering=0) as f:
+            while True:
+                n = 0
+                while n < len(buf):
+                    read = f.readinto(view[n:])
+                    if not read:
+                        break
+                    n += read
+                if n == 0:
+                    break
+                data = view[:n]
+                file_hash.update(data)
+                for offset in range(0, n, chunk_size):
+                    chunk_hashes.append(merkle.hash_leaf(data[offset:offset + chunk_size]))
+                if n < len(buf):
+                    break
         
         return {
             'size': size,
             'hash': file_hash.hexdigest(),
-            'num_chunks': num_chunks
+            'num_chunks': num_chunks,
+            'merkle_root': merkle.MerkleTree(chunk_hashes).root(),
+            'chunk_size': chunk_size,
+            'chunk_hashes': [h.hex() for h in chunk_hashes]
         }
 
+    def get_merkle_tree(self, file_info):
+        """Merkle tree for an indexed file (cached)"""
+        root = file_info['merkle_root']
+        tree = self.merkle_trees.get(root)
+        if tree is None:
+            leaves = [bytes.fromhex(h) for h in file_info['chunk_hashes']]
+            tree = merkle.MerkleTree(leaves)
+            self.merkle_trees[root] = tree
+        return tree
+
     # Refresh
     def maintenance(self):
         """Periodic maintenance"""
         while self.running: 
             self.index_files()
+            self.dump_metrics()
             # Sleep because it's periodic
             time.sleep(15)
     
+    def dump_metrics(self):
+        """Write the metrics to metrics_file (if set)"""
+        if not self.metrics_file:
+            return
+        try:
+            self.metrics.dump(self.metrics_file, self.metrics_extra())
+        except OSError as e:
+            print(f"Could not write metrics: {e}")
+    
+    def metrics_extra(self):
+        """Chunk cache and upload slot stats to go with the metrics snapshot"""
+        return {
+            'chunk_cache': self.chunk_cache.stats(),
+            'uploads': self.uploads.stats()
+        }
+    
     def add_peer(self, ip, port):
         """Manually add a peer"""
         peer = (ip, int(port))
@@ -106,6 +450,10 @@ class P2PNode:
         peer = (ip, int(port))
         if peer in self.peers:
             self.peers.remove(peer)
+            self.peer_lists.pop(peer, None)
+            self.unsynced_peers.discard(peer)
+            self.peer_stats.forget(peer)
+            self.pool.close(peer)
             print(f"Removed peer: {ip}:{port}")
             return True
         return False
@@ -114,126 +462,186 @@ class P2PNode:
         """Get list of peers"""
         return self.peers.copy()
     
+    def best_peers(self):
+        """Peers that aren't backed off, fastest and healthiest first"""
+        return self.peer_stats.rank(self.get_peers())
+    
+    def peer_request(self, peer, request, timeout, rtt=True):
+        """Request to peer that keeps its stats (rtt=False for big transfers)"""
+        start = time.time()
+        try:
+            with self.metrics.timer('request.' + request['type']):
+                response = self.pool.request(peer, request, timeout)
+        except OSError:
+            self.metrics.count('request_failures')
+            if self.peer_stats.failed(peer) and peer in self.peers:
+                print(f"\n{peer[0]}:{peer[1]} keeps failing, evicting it")
+                self.remove_peer(*peer)
+            raise
+        # bytes are counted by the connection (whole messages)
+        self.peer_stats.answered(peer, time.time() - start if rtt else None)
+        return response
+    
     def get_files(self):
         """list of local files"""
-        with self.lock:
-            return list(self.files.keys())
+        return list(self.index.files.keys())
     
     def request_file_list(self, peer):
         """Request file list from peer"""
-        # Connect to peer
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(5.0)
-        s.connect(peer)
-        
-        # request
         request = {
             'type': 'list'
         }
-        s.sendall(json.dumps(request).encode('utf-8'))
-        
-        # Read
-        data = s.recv(4096)
-        s.close()
-        
-        response = json.loads(data.decode('utf-8'))
+        response, _ = self.peer_request(peer, request, 5.0)
         return response.get('files', [])
     
-    def request_file_info(self, peer, filename):
-        """Request file"""
-        # Connect
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(5.0)
-        s.connect(peer)
+    def sync_file_list(self, peer, timeout=5.0):
+        """Bring the cached file list of peer up to date (None if the peer can't)"""
+        remote = self.peer_lists.setdefault(peer, file_index.RemoteIndex())
+        request = {
+            'type': 'list',
+            'since': remote.generation if remote.generation is not None else 0,
+            'epoch': remote.epoch
+        }
+        response, _ = self.peer_request(peer, request, timeout)
+        if 'generation' not in response:
+            # old peer, sent its plain list
+            return None
+        if response.get('too_large'):
+            # too many files to keep a copy of, search the peer instead
+            self.peer_lists.pop(peer, None)
+            return None
+        remote.apply(response)
+        return remote
     
-        # request
+    def request_file_info(self, peer, filename):
+        """Request file info (asked again while the peer is still hashing it)"""
         request = {
             'type': 'info',
             'filename': filename
         }
-        s.sendall(json.dumps(request).encode('utf-8'))
-        
-        # Read
-        data = s.recv(4096)
-        s.close()
-        
-        response = json.loads(data.decode('utf-8'))
+        for _ in range(HASH_RETRIES):
+            response, _ = self.peer_request(peer, request, 5.0)
+            # the peer already waited HASH_WAIT on its side before answering
+            if not response.get('hashing'):
+                break
         return response.get('info')
     
-    def download_chunk(self, peer, filename, chunk_index):
-        """Download a file chunk"""
-        # Connect to peer
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(10.0)
-        s.connect(peer)
+    def download_chunk(self, peer, filename, chunk_index, merkle_root=None, num_chunks=None):
+        """Download a file chunk (checked against merkle_root if given)
+        
+        num_chunks is needed with merkle_root, it fixes the shape of the
+        proof. Raises download.Choked if the peer has no upload slot for us.
+        """
         request = {
             'type': 'chunk',
             'filename': filename,
             'chunk_index': chunk_index
         }
-        s.sendall(json.dumps(request).encode('utf-8'))
-        
-        # header (size is 4 bytes)
-        header_size_bytes = s.recv(4)
-        if not header_size_bytes:
-            return None
-        header_size = int.from_bytes(header_size_bytes, byteorder='big')
-        header_bytes = s.recv(header_size)
-        if not header_bytes:
+        if merkle_root:
+            request['proof'] = True
+        with self.metrics.timer('chunk_receive'):
+            data = self.receive_chunk(peer, request, merkle_root, num_chunks)
+        self.metrics.count('chunks_received' if data is not None else 'chunks_rejected')
+        return data
+    
+    def receive_chunk(self, peer, request, merkle_root, num_chunks):
+        """Request a chunk and check it, None if it didn't come or is bad"""
+        try:
+            header, data = self.peer_request(peer, request, 10.0, rtt=False)
+        except OSError:
             return None
-        header = json.loads(header_bytes.decode('utf-8'))
         
-        # Read chunk data
+        if header.get('type') == 'choked':
+            raise download.Choked(header.get('retry_after', 1.0))
+        if header.get('type') != 'chunk_response' or data is None:
+            return None
         chunk_size = header.get('chunk_size')
-        data = bytearray()
-        bytes_received = 0
+        if not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            # checked before inflating, zlib takes 0 as "no limit"
+            return None
+        if header.get('encoding'):
+            # verified below on the original bytes
+            data = compression.decompress(header['encoding'], data, chunk_size)
+            if data is None:
+                return None
+        if len(data) != chunk_size:
+            return None
+        if merkle_root and not merkle.verify_chunk(data, header.get('proof', []), merkle_root,
+                                                   request['chunk_index'], num_chunks or 0):
+            print(f"\nChunk {request['chunk_index']} from {peer[0]}:{peer[1]} failed verification")
+            return None
+        return data
+
+    def find_file_sources(self, filename, file_hash):
+        """Peers that have filename with the same hash"""
+        sources = []
+        sources_lock = threading.Lock()
         
-        while bytes_received < chunk_size:
-            bytes_to_read = min(4096, chunk_size - bytes_received)
-            chunk = s.recv(bytes_to_read)
-            if not chunk:
-                break
-            data.extend(chunk)
-            bytes_received += len(chunk)
+        def check(peer):
+            try:
+                info = self.request_file_info(peer, filename)
+            except OSError:
+                return
+            if info and info['hash'] == file_hash:
+                with sources_lock:
+                    sources.append(peer)
         
-        s.close()
-        return data
+        # ask every peer at once so a dead one doesn't hold up the rest,
+        # backed off ones aren't asked at all
+        threads = [threading.Thread(target=check, args=(peer,), daemon=True)
+                   for peer in self.best_peers()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.peer_stats.rank(sources)
 
-    def download_file(self, peer, filename):
-        """Download file"""
+    def download_file(self, peer, filename, swarm=False, job=None):
+        """Download file (from every peer that has it when swarm is set)
+        
+        job: the download_queue.DownloadJob running it, it gets the
+        transfer so it can pause or cancel it.
+        """
         file_info = self.request_file_info(peer, filename)
+        if not file_info:
+            print(f"\n{filename} not found on {peer[0]}:{peer[1]}")
+            return False
+        # peers that don't say use CHUNK_SIZE
+        chunk_size = file_info.get('chunk_size', CHUNK_SIZE)
+        if not self.valid_chunk_size(file_info, chunk_size):
+            print(f"\n{peer[0]}:{peer[1]} sent bad chunk info for {filename}")
+            return False
+        
+        peers = [peer]
+        if swarm:
+            for source in self.find_file_sources(filename, file_info['hash']):
+                if source not in peers:
+                    peers.append(source)
+            print(f"Downloading {filename} from {len(peers)} peers")
         
         # output 
         output_path = os.path.join(self.shared_dir, filename)
-        temp_path = os.path.join(self.shared_dir, f".temp_{filename}")
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        temp_path = self.temp_path(filename)
+        
+        # Download chunks (several in flight, written at their offsets).
+        # A temp file left by an earlier attempt is resumed, not restarted
+        transfer = download.FileDownload(self, peers, filename, file_info, chunk_size,
+                                         temp_path, self.max_outstanding)
+        if job is not None:
+            job.attach(transfer)
+        ok = transfer.run()
+        for source in transfer.sources:
+            self.peer_stats.transferred(source.peer, source.bytes, time.time() - source.started)
+        if not ok:
+            if not transfer.stopped:
+                print("\nDownload failed (run it again to resume)")
+            return False
         
-        # Download chunks
-        num_chunks = file_info['num_chunks']
+        # chunks arrive out of order so hash the finished file
         file_hash = hashlib.sha256()
-        for i in range(num_chunks):
-            chunk_data = self.download_chunk(peer, filename, i)
-            progress = ((i + 1) / num_chunks) * 100
-            print(f"Downloading chunk {i+1}/{num_chunks} ({progress}%)...")
-            if not chunk_data:
-                print("\nDownload failed")
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                return False
-
-            write = ""
-            if i > 0:
-                write = "ab"
-            else:
-                write = "wb"
-            
-            with open(temp_path, write) as f:
-                f.write(chunk_data)
-            
-            #print(file_hash)
-            file_hash.update(chunk_data)
-            #print(file_hash)
+        with open(temp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                file_hash.update(chunk)
         
         print()
         
@@ -243,8 +651,14 @@ class P2PNode:
         print(f"calc hash: {calculated_hash} expected hash: {expected_hash}")
         
         if calculated_hash != expected_hash:
-            os.remove(temp_path)
+            if file_info.get('merkle_root'):
+                # every chunk matched the merkle root, so the root and hash
+                # the peer sent disagree: refetching won't help, keep them
+                print(f"\n{filename} matches its merkle root but not its hash, keeping the chunks")
+            else:
+                transfer.discard()
             return False
+        transfer.bitfield.remove()
         if os.path.exists(output_path):
             os.remove(output_path)
         os.rename(temp_path, output_path)
@@ -255,32 +669,143 @@ class P2PNode:
         
         return True
 
-    def search_files(self, query):
-        """Search for files matching query"""
+    def temp_path(self, filename):
+        """Where filename is downloaded to until it's complete"""
+        return os.path.join(self.shared_dir, f".temp_{filename}")
+    
+    def discard_download(self, filename):
+        """Delete the temp file and bitfield of an unfinished download"""
+        temp_path = self.temp_path(filename)
+        for path in (temp_path, temp_path + download.BITFIELD_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    @staticmethod
+    def valid_chunk_size(file_info, chunk_size):
+        """chunk_size is one we'd use and matches the chunk count"""
+        if not isinstance(chunk_size, int) or not CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            return False
+        return file_info.get('num_chunks') == math.ceil(file_info.get('size', 0) / chunk_size)
+    
+    def search_local(self, query):
+        """Local files matching query, as (filename, info) pairs, best first"""
+        files = self.index.files
+        # search index may be a rebuild ahead or behind the snapshot
+        return [(filename, files[filename]) for filename in self.search_index.search(query)
+                if filename in files]
+    
+    def request_search(self, peer, query, timeout=5.0):
+        """Ask peer to search its own files (None if the peer can't)"""
+        request = {
+            'type': 'search',
+            'query': query
+        }
+        response, _ = self.peer_request(peer, request, timeout)
+        if response.get('type') != 'search_response':
+            return None
+        return response.get('results', [])
+    
+    def search_peer(self, peer, query, timeout=5.0):
+        """Files matching query on one peer"""
+        # cached list, usually costs one tiny "nothing changed" round trip
+        remote = None
+        if peer not in self.unsynced_peers:
+            try:
+                remote = self.sync_file_list(peer, timeout)
+            except ConnectionError:
+                # e.g. a list over the frame limit, don't keep asking for it
+                self.peer_lists.pop(peer, None)
+                self.unsynced_peers.add(peer)
+        if remote is not None:
+            return remote.search(query)
+        
+        hits = self.request_search(peer, query, timeout)
+        if hits is not None:
+            return hits
+        
+        # peer doesn't know 'search', match its list the way we match our own
+        # files and ask for each match
+        names = search_index.SearchIndex()
+        names.update(self.request_file_list(peer))
+        hits = []
+        for filename in names.search(query):
+            file_info = self.request_file_info(peer, filename)
+            if file_info:
+                hits.append(dict(file_info, filename=filename))
+        return hits
+    
+    def search_files(self, query, on_result=None, on_error=None, deadline=SEARCH_DEADLINE):
+        """Search for files matching query
+        
+        Every peer is asked at once. Results are passed to on_result as
+        each peer answers, and peers that fail or miss the deadline are
+        passed to on_error (peer, reason), so a dead peer never holds up
+        the search. Returns every result.
+        """
         results = []
         
+        def emit(result):
+            results.append(result)
+            if on_result:
+                on_result(result)
+        
         # Check local files
-        for filename in self.files:
-            if query.lower() in filename.lower():
-                results.append({
-                    'filename': filename,
-                    'peer': 'local',
-                    'size': self.files[filename]['size']
+        for filename, file_info in self.search_local(query):
+            emit({
+                'filename': filename,
+                'peer': 'local',
+                'size': file_info['size'],
+                'hash': file_info.get('hash')
+            })
+        
+        # Check peers (all at once, one round trip each)
+        replies = queue.Queue()
+        
+        def ask(peer):
+            try:
+                replies.put((peer, self.search_peer(peer, query, deadline), None))
+            except (OSError, ValueError) as e:
+                replies.put((peer, None, e))
+        
+        ready = self.best_peers()
+        for peer in self.get_peers():
+            if peer not in ready and on_error:
+                wait = self.peer_stats.snapshot(peer)['backoff']
+                on_error(peer, f"failing, next try in {wait:.0f}s")
+        # fastest first so their answers come in first
+        pending = set(ready)
+        for peer in ready:
+            threading.Thread(target=ask, args=(peer,), daemon=True).start()
+        
+        end = time.time() + deadline
+        while pending:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            try:
+                peer, hits, error = replies.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.discard(peer)
+            
+            if error is not None:
+                if on_error:
+                    on_error(peer, str(error) or type(error).__name__)
+                continue
+            for hit in hits:
+                emit({
+                    'filename': hit['filename'],
+                    'peer': peer,
+                    'size': hit['size'],
+                    'hash': hit.get('hash')
                 })
         
-        # Check peers
-        for peer in self.peers:
-            peer_files = self.request_file_list(peer)
-            for filename in peer_files:
-                if query.lower() in filename.lower():
-                    # Get file info
-                    file_info = self.request_file_info(peer, filename)
-                    if file_info:
-                        results.append({
-                            'filename': filename,
-                            'peer': peer,
-                            'size': file_info['size']
-                        })
+        # too slow, their answers get dropped
+        for peer in pending:
+            if on_error:
+                on_error(peer, 'no answer before the deadline')
         
         return results
 
@@ -319,95 +844,370 @@ class P2PNode:
         server.close()
     
     def handle_client(self, client, addr):
-        """Handle client request"""
+        """Handle client connection"""
         # Set socket timeout
         client.settimeout(5.0)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         
-        # Read request
+        try:
+            # Old clients send one bare JSON request, new ones send framed messages
+            first = client.recv(1, socket.MSG_PEEK)
+            if first == b'{':
+                self.handle_single_request(client, addr)
+            elif first:
+                self.handle_framed_requests(client, addr)
+        except (OSError, ValueError):
+            pass
+        finally:
+            client.close()
+    
+    def handle_single_request(self, client, addr):
+        """One JSON request, then the connection is closed"""
         data = client.recv(4096)
         if not data:
             return
         
         # Parse request
         request = json.loads(data.decode('utf-8'))
+        self.metrics.peer_bytes(addr, received=len(data))
+        result = self.handle_request(request)
+        if result is None:
+            return
+        
+        response, payload = result
+        if payload is None:
+            response_bytes = json.dumps(response).encode('utf-8')
+            client.sendall(response_bytes)
+            self.metrics.peer_bytes(addr, sent=len(response_bytes))
+            return
+        
+        # header size + header + chunk
+        try:
+            # one-off connection, only the total upload limit applies
+            self.wait_upload(None, len(payload))
+            header_bytes = json.dumps(response).encode('utf-8')
+            header_size = len(header_bytes).to_bytes(4, byteorder='big')
+            client.sendall(header_size + header_bytes)
+            protocol.send_payload(client, payload)
+            self.metrics.peer_bytes(addr, sent=len(header_size) + len(header_bytes) + len(payload))
+        finally:
+            protocol.close_payload(payload)
+    
+    def handle_framed_requests(self, client, addr):
+        """Serve requests on a persistent connection until it closes
+        
+        Starts in JSON framing, a hello from the client switches it to
+        the version both sides speak.
+        """
+        client.settimeout(IDLE_TIMEOUT)
+        framing = protocol.JSON_FRAMING
+        encoding = None
+        chokeable = False
+        chunk_sizes = False
+        # bytes are counted under the peer's listen address once the hello says it
+        peer = addr
+        try:
+            while self.running:
+                try:
+                    message = protocol.recv_sized_message(client, framing)
+                except socket.timeout:
+                    # idle too long
+                    break
+                if message is None:
+                    break
+                
+                request, _, size = message
+                if request.get('type') == 'hello':
+                    peer = self.peer_address(addr, request)
+                    self.metrics.peer_bytes(peer, received=size)
+                    response = self.handle_hello(request)
+                    sent = protocol.send_message(client, response, framing=framing)
+                    self.metrics.peer_bytes(peer, sent=sent)
+                    framing = protocol.FRAMINGS[response['version']]
+                    encoding = response.get('encoding')
+                    chokeable = 'choke' in response['features']
+                    chunk_sizes = 'chunk_size' in response['features']
+                    continue
+                self.metrics.peer_bytes(peer, received=size)
+                
+                if chokeable and request.get('type') == 'chunk':
+                    retry_after = self.uploads.check(addr)
+                    if retry_after is not None:
+                        sent = protocol.send_message(client, self.choked(request, retry_after), framing=framing)
+                        self.metrics.peer_bytes(peer, sent=sent)
+                        continue
+                
+                result = self.handle_request(request, chunk_sizes)
+                if result is None:
+                    result = ({'type': 'error', 'error': 'Unknown request type'}, None)
+                
+                response, payload = result
+                if encoding:
+                    response, payload = self.encode_chunk(response, payload, encoding)
+                response['id'] = request.get('id')
+                try:
+                    if payload:
+                        self.wait_upload(addr, len(payload))
+                    sent = protocol.send_message(client, response, payload, framing)
+                    self.metrics.peer_bytes(peer, sent=sent)
+                finally:
+                    protocol.close_payload(payload)
+        finally:
+            # frees its upload slot
+            self.uploads.disconnect(addr)
+    
+    def wait_upload(self, peer, nbytes):
+        """Block until the upload limits let nbytes go to peer"""
+        delay = self.uploads.throttle(peer, nbytes)
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.uploads.throttle(peer, nbytes)
+    
+    @staticmethod
+    def choked(request, retry_after):
+        """Answer to a chunk request from a peer without an upload slot"""
+        return {
+            'type': 'choked',
+            'id': request.get('id'),
+            'retry_after': retry_after
+        }
+    
+    @staticmethod
+    def peer_address(addr, hello):
+        """Address of a connecting peer: its IP and the listen port its hello gave"""
+        port = hello.get('port')
+        if isinstance(port, int) and 0 < port < 65536:
+            return (addr[0], port)
+        return addr
+    
+    def handle_hello(self, request):
+        """Pick the protocol version for a connection"""
+        response = {
+            'type': 'hello_response',
+            'id': request.get('id'),
+            'version': protocol.choose_version(request.get('versions')),
+            'features': [f for f in request.get('features') or [] if f in protocol.FEATURES]
+        }
+        if self.compress_level > 0 and compression.ZLIB in (request.get('encodings') or []):
+            response['encoding'] = compression.ZLIB
+        return response
+    
+    def encode_chunk(self, response, payload, encoding):
+        """Compress a chunk response if its file is worth compressing"""
+        if response.get('type') != 'chunk_response' or payload is None:
+            return response, payload
+        if not self.is_compressible(response['filename']):
+            return response, payload
+        
+        data = payload
+        if isinstance(payload, protocol.FileRegion):
+            try:
+                data = payload.read()
+            finally:
+                protocol.close_payload(payload)
+        packed = compression.compress(data, self.compress_level)
+        if packed is None:
+            return response, data
+        response['encoding'] = encoding
+        return response, packed
+    
+    def is_compressible(self, filename):
+        """Whether chunks of filename shrink (sampled once per file version)"""
+        file_info = self.index.files.get(filename)
+        if file_info is None or 'hash' not in file_info:
+            return False
+        compressible = self.compressible.get(file_info['hash'])
+        if compressible is None:
+            try:
+                compressible = compression.is_compressible(
+                    os.path.join(self.shared_dir, filename), file_info['size'])
+            except OSError:
+                return False
+            self.compressible[file_info['hash']] = compressible
+        return compressible
+    
+    def handle_request(self, request, chunk_sizes=False):
+        """Dispatch a request, returns (response, payload) or None
+        
+        chunk_sizes: the peer knows about per-file chunk sizes (said so
+        in the hello), otherwise it's served CHUNK_SIZE chunks.
+        """
         req_type = request.get('type')
         # print(req_type)
-        
+        if req_type not in SERVED_TYPES:
+            return None
+        if not isinstance(request.get('filename', ''), str):
+            return {'type': 'error', 'error': 'Bad filename'}, None
+        with self.metrics.timer('serve.' + req_type):
+            return self.dispatch_request(req_type, request, chunk_sizes)
+    
+    def dispatch_request(self, req_type, request, chunk_sizes):
+        """Handler for a known request type"""
         if req_type == 'list':
-            self.handle_list_request(client)
+            return self.handle_list_request(request)
             
         elif req_type == 'info':
-            self.handle_info_request(client, request)
+            return self.handle_info_request(request, chunk_sizes)
 
         elif req_type == 'chunk':
-            self.handle_chunk_request(client, request)
+            return self.handle_chunk_request(request, chunk_sizes)
 
-        client.close()
+        elif req_type == 'search':
+            return self.handle_search_request(request)
+        
+        return None
     
-    def handle_list_request(self, client):
-        """Request for file list"""
+    def handle_list_request(self, request):
+        """Request for file list (only changes if the peer sent 'since')"""
+        current = self.index
         response = {
             'type': 'list_response',
-            'files': list(self.files.keys())
+            'epoch': self.epoch,
+            'generation': current.version
         }
-        client.sendall(json.dumps(response).encode('utf-8'))
+        since = request.get('since')
+        if since is None:
+            response['files'] = list(current.files.keys())
+            return response, None
+        
+        changes = None
+        if request.get('epoch') == self.epoch:
+            changes = self.changes_since(since, current.version)
+        count = len(current.files) if changes is None else len(changes[0]) + len(changes[1])
+        if count > MAX_SYNC_FILES:
+            # the peer searches us instead of keeping a copy
+            response['too_large'] = True
+            return response, None
+        
+        if changes is None:
+            # peer's copy is from another run or too old, send everything
+            response['full'] = True
+            added = {filename: self.public_info(info) for filename, info in current.files.items()}
+            removed = []
+        else:
+            added, removed = changes
+            response['since'] = since
+        response['added'] = added
+        response['removed'] = removed
+        return response, None
     
-    def handle_info_request(self, client, request):
+    def handle_info_request(self, request, chunk_sizes=False):
         """Handle file info request"""
         filename = request.get('filename')
-        file_info = self.files.get(filename)
+        file_info = self.wait_for_hash(filename)
+        if file_info is not None and 'hash' not in file_info:
+            return self.still_hashing()
+        if file_info is not None:
+            file_info = self.public_info(file_info)
+            if not chunk_sizes:
+                file_info = self.fixed_chunk_info(file_info)
         
         response = {
             'type': 'info_response',
             'filename': filename,
             'info': file_info
         }
-        client.sendall(json.dumps(response).encode('utf-8'))
+        return response, None
+    
+    @staticmethod
+    def still_hashing():
+        """Error for a file that didn't get hashed in time"""
+        response = {
+            'type': 'error',
+            'error': 'File is still being hashed, try again',
+            'hashing': True
+        }
+        return response, None
+    
+    def handle_search_request(self, request):
+        """Handle search request (filtered here, not by the client)"""
+        query = request.get('query', '')
+        results = []
+        for filename, file_info in self.search_local(query):
+            hit = self.public_info(file_info)
+            hit['filename'] = filename
+            results.append(hit)
+        
+        response = {
+            'type': 'search_response',
+            'query': query,
+            'results': results
+        }
+        return response, None
     
-    def handle_chunk_request(self, client, request):
+    def handle_chunk_request(self, request, chunk_sizes=False):
         """Handle file chunk request"""
         filename = request.get('filename')
         chunk_index = request.get('chunk_index')
+        if not isinstance(chunk_index, int) or chunk_index < 0:
+            response = {
+                'type': 'error',
+                'error': 'Chunk index out of range'
+            }
+            return response, None
+        file_info = self.wait_for_hash(filename)
         
         # Check if file exists
-        if filename not in self.files:
+        if file_info is None:
             response = {
                 'type': 'error',
                 'error': 'File not found'
             }
-            client.sendall(json.dumps(response).encode('utf-8'))
-            return
+            return response, None
+        if 'hash' not in file_info:
+            return self.still_hashing()
         
+        # cached fd and size (dropped when the file is re-indexed)
         file_path = os.path.join(self.shared_dir, filename)
-        file_size = os.path.getsize(file_path)
+        try:
+            handle = self.file_handles.acquire(filename, file_path)
+        except OSError:
+            response = {
+                'type': 'error',
+                'error': 'File not found'
+            }
+            return response, None
+        file_size = handle.size
         
-        # Calculate chunk offset and size
-        chunk_offset = chunk_index * CHUNK_SIZE
-        chunk_size = min(CHUNK_SIZE, file_size - chunk_offset)
+        # Calculate chunk offset and size (in the file's chunks if the
+        # peer knows them, CHUNK_SIZE ones otherwise)
+        file_chunk_size = file_info.get('chunk_size', CHUNK_SIZE)
+        unit = file_chunk_size if chunk_sizes else CHUNK_SIZE
+        chunk_offset = chunk_index * unit
+        chunk_size = min(unit, file_size - chunk_offset)
         
         if chunk_offset >= file_size:
+            self.file_handles.release(handle)
             response = {
                 'type': 'error',
                 'error': 'Chunk index out of range'
             }
-            client.sendall(json.dumps(response).encode('utf-8'))
-            return
+            return response, None
         
-        # Send chunk header
+        # chunk header
         header = {
             'type': 'chunk_response',
             'filename': filename,
             'chunk_index': chunk_index,
             'chunk_size': chunk_size
         }
+        if request.get('proof') and unit == file_chunk_size:
+            header['proof'] = self.get_merkle_tree(file_info).proof(chunk_index)
         
-        header_bytes = json.dumps(header).encode('utf-8')
-        header_size = len(header_bytes).to_bytes(4, byteorder='big')
-        # Send header size + header
-        client.sendall(header_size)
-        client.sendall(header_bytes)
+        # popular chunks come from memory, read through the file's mmap
+        key = (filename, file_info['hash'], unit, chunk_index)
+        data = self.chunk_cache.get(key)
+        if data is None and self.chunk_cache.want(key):
+            try:
+                data = handle.read(chunk_offset, chunk_size)
+                self.chunk_cache.put(key, data)
+            except (OSError, ValueError):
+                data = None
+        if data is not None:
+            self.file_handles.release(handle)
+            return header, data
         
-        # Send
-        with open(file_path, 'rb') as f:
-            f.seek(chunk_offset)
-            client.sendall(f.read(chunk_size))
\ No newline at end of file
+        # sent with sendfile, the chunk never gets copied into Python
+        payload = protocol.FileRegion(handle.file, chunk_offset, chunk_size,
+                                      lambda: self.file_handles.release(handle))
+        return header, payload
@@ -0,0 +1,135 @@
+"""
+Peer health tracking for P2P file sharing app
+"""
+import threading
+import time
+
+# Weight of the newest sample in the moving averages
+EWMA_WEIGHT = 0.3
+# First backoff after a failure, doubled on each failure in a row...
+BACKOFF_BASE = 1.0
+# ...up to this
+BACKOFF_MAX = 300.0
+# Failures in a row before a peer can be evicted...
+EVICT_FAILURES = 8
+# ...if it also hasn't answered anything for this long
+EVICT_AFTER = 600.0
+
+
+def ewma(average, sample):
+    """Moving average with sample folded in (the first sample starts it)"""
+    if average is None:
+        return sample
+    return (1 - EWMA_WEIGHT) * average + EWMA_WEIGHT * sample
+
+
+class PeerRecord:
+    """What we know about how one peer behaves"""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.rtt = None          # seconds, EWMA
+        self.throughput = None   # bytes/s downloaded from it, EWMA
+        self.failures = 0        # in a row
+        self.total_failures = 0
+        self.last_seen = None
+        self.added = time.time()
+        self.retry_at = 0.0      # backed off until
+
+    def backing_off(self, now):
+        """Seconds left before this peer should be tried again (0 = go ahead)"""
+        return max(0.0, self.retry_at - now)
+
+    def score(self):
+        """Sort key, best peer first: healthy, then fastest, then lowest RTT"""
+        return (self.failures > 0,
+                -(self.throughput or 0.0),
+                self.rtt if self.rtt is not None else float('inf'))
+
+
+class PeerTracker:
+    """Per-peer RTT, throughput, failures and last-seen time
+
+    A peer that fails is backed off exponentially (searches and downloads
+    skip it meanwhile, so a dead peer doesn't cost a connect timeout every
+    time), and one that keeps failing and hasn't been seen in a while is
+    reported for eviction.
+    """
+
+    def __init__(self):
+        self.records = {}  # peer -> PeerRecord
+        self.lock = threading.Lock()
+
+    def get_record(self, peer):
+        """Record for peer (lock held)"""
+        record = self.records.get(peer)
+        if record is None:
+            record = PeerRecord(peer)
+            self.records[peer] = record
+        return record
+
+    def answered(self, peer, rtt=None):
+        """Peer answered a request (rtt only for small requests)"""
+        with self.lock:
+            record = self.get_record(peer)
+            if rtt is not None:
+                record.rtt = ewma(record.rtt, rtt)
+            record.failures = 0
+            record.retry_at = 0.0
+            record.last_seen = time.time()
+
+    def transferred(self, peer, nbytes, seconds):
+        """Downloaded nbytes from peer in seconds"""
+        if nbytes <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            record = self.get_record(peer)
+            record.throughput = ewma(record.throughput, nbytes / seconds)
+
+    def failed(self, peer):
+        """A request to peer failed, returns True if it should be evicted"""
+        now = time.time()
+        with self.lock:
+            record = self.get_record(peer)
+            record.failures += 1
+            record.total_failures += 1
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (record.failures - 1))
+            record.retry_at = now + backoff
+            last = record.last_seen if record.last_seen is not None else record.added
+            return record.failures >= EVICT_FAILURES and now - last >= EVICT_AFTER
+
+    def available(self, peer):
+        """Peer isn't backed off"""
+        with self.lock:
+            record = self.records.get(peer)
+            return record is None or not record.backing_off(time.time())
+
+    def rank(self, peers):
+        """Peers that aren't backed off, best first"""
+        now = time.time()
+        with self.lock:
+            ready = [self.records.get(peer) or PeerRecord(peer) for peer in peers]
+            ready = [r for r in ready if not r.backing_off(now)]
+            ready.sort(key=PeerRecord.score)
+            return [r.peer for r in ready]
+
+    def forget(self, peer):
+        """Drop peer's record"""
+        with self.lock:
+            self.records.pop(peer, None)
+
+    def snapshot(self, peer):
+        """Stats of peer as a dict (for display)"""
+        now = time.time()
+        with self.lock:
+            record = self.records.get(peer)
+            if record is None:
+                record = PeerRecord(peer)
+            return {
+                'rtt': record.rtt,
+                'throughput': record.throughput,
+                'failures': record.failures,
+                'total_failures': record.total_failures,
+                'last_seen': record.last_seen,
+                'backoff': record.backing_off(now)
+            }
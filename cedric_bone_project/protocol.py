@@ -0,0 +1,429 @@
+"""
+Message framing for P2P file sharing app
+"""
+import os
+import json
+import socket
+import struct
+
+# Every framed message starts with a 4 byte big-endian header length
+HEADER_SIZE_BYTES = 4
+# Largest header/metadata accepted (a full file list of a big share)
+MAX_META_SIZE = 16 * 1024 * 1024
+# Largest payload accepted (chunks are at most 1MB)
+MAX_PAYLOAD_SIZE = 4 * 1024 * 1024
+
+
+class FileRegion:
+    """Payload sent straight from a file with sendfile
+
+    The bytes go from the page cache to the socket without ever being
+    copied into Python. release is called by close() once it's sent.
+    """
+
+    def __init__(self, file, offset, count, release=None):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.release = release
+
+    def __len__(self):
+        return self.count
+
+    def send(self, sock):
+        """Send the region on sock"""
+        sent = sock.sendfile(self.file, self.offset, self.count)
+        if sent != self.count:
+            # file shrank under us, the receiver would lose sync
+            raise ConnectionError(f"Sent {sent} of {self.count} bytes")
+
+    def read(self):
+        """Read the region into bytes (for paths that can't use sendfile)"""
+        data = os.pread(self.file.fileno(), self.count, self.offset)
+        if len(data) != self.count:
+            raise ConnectionError(f"Read {len(data)} of {self.count} bytes")
+        return data
+
+    def close(self):
+        """Give back the file"""
+        if self.release:
+            self.release()
+            self.release = None
+
+
+def send_payload(sock, payload):
+    """Send raw payload bytes or a FileRegion"""
+    if isinstance(payload, FileRegion):
+        payload.send(sock)
+    else:
+        sock.sendall(payload)
+
+
+def close_payload(payload):
+    """Release whatever a payload holds on to"""
+    if isinstance(payload, FileRegion):
+        payload.close()
+
+
+def recv_exact(sock, size):
+    """Read exactly size bytes (None if peer closed before the first byte)"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        try:
+            n = sock.recv_into(view[pos:])
+        except socket.timeout:
+            if pos == 0:
+                raise
+            raise ConnectionError("Timed out in the middle of a message")
+        if n == 0:
+            if pos == 0:
+                return None
+            raise ConnectionError("Connection closed in the middle of a message")
+        pos += n
+    return buf
+
+
+def check_size(size, limit, what):
+    """Refuse a length off the wire before allocating for it"""
+    if size > limit:
+        raise ConnectionError(f"{what} of {size} bytes is over the {limit} byte limit")
+
+
+def encode_header(header, payload=None):
+    """Header length + JSON header bytes (version 1 framing and old chunk responses)"""
+    if payload is not None:
+        header['payload_size'] = len(payload)
+    header_bytes = json.dumps(header).encode('utf-8')
+    return len(header_bytes).to_bytes(HEADER_SIZE_BYTES, byteorder='big') + header_bytes
+
+
+def decode_header(header_bytes):
+    """Header dict from its JSON bytes (ValueError if it isn't one)"""
+    header = json.loads(bytes(header_bytes).decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError("Message header is not a JSON object")
+    return header
+
+
+class JsonFraming:
+    """Version 1: 4 byte length + JSON header (+ payload_size raw bytes)
+
+    Every connection starts out in this framing so the hello handshake
+    works with any peer that has framed messages at all.
+    """
+
+    version = 1
+    prefix_size = HEADER_SIZE_BYTES
+
+    def encode(self, header, payload=None):
+        """Bytes to send before the payload"""
+        return encode_header(header, payload)
+
+    def meta_size(self, prefix):
+        """Bytes of header after the prefix"""
+        return int.from_bytes(prefix, byteorder='big')
+
+    def decode(self, prefix, meta):
+        """Header dict (payload_size says how many payload bytes follow)"""
+        return decode_header(meta)
+
+
+# Version 2 frame: type code, flags, request id, meta length, payload length
+FRAME = struct.Struct('!BBIII')
+# Frame flag: meta is JSON rather than packed
+FLAG_JSON = 0x01
+# Frame flag: packed file info carries a chunk size ('chunk_size' feature)
+FLAG_CHUNK_SIZE = 0x02
+# Message type codes
+TYPE_CODES = {
+    'json': 0,
+    'list': 1,
+    'list_response': 2,
+    'info': 3,
+    'info_response': 4,
+    'chunk': 5,
+    'chunk_response': 6,
+    'search': 7,
+    'search_response': 8,
+    'error': 9,
+    'hello': 10,
+    'hello_response': 11,
+    'choked': 12,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+# No request id (uint32 can't hold None)
+NO_ID = 0xFFFFFFFF
+
+# Packed metadata for the hot message types
+CHUNK_REQUEST = struct.Struct('!IB')         # chunk index, flags
+CHUNK_RESPONSE = struct.Struct('!IIBB')      # chunk index, chunk size, proof length, flags
+PROOF_STEP = struct.Struct('!c32s')          # side, sibling hash
+FILE_INFO = struct.Struct('!QI32s32s')       # size, num chunks, hash, merkle root
+FILE_INFO_SIZED = struct.Struct('!QII32s32s')  # size, num chunks, chunk size, hash, merkle root
+CHUNK_FLAG_PROOF = 0x01
+CHUNK_FLAG_ZLIB = 0x02
+
+CHUNK_REQUEST_FIELDS = {'filename', 'chunk_index', 'proof'}
+CHUNK_RESPONSE_FIELDS = {'filename', 'chunk_index', 'chunk_size', 'proof', 'encoding'}
+INFO_FIELDS = {'size', 'hash', 'num_chunks', 'merkle_root'}
+
+
+def pack_chunk(header):
+    """Chunk request metadata and frame flags"""
+    flags = CHUNK_FLAG_PROOF if header.get('proof') else 0
+    return CHUNK_REQUEST.pack(header['chunk_index'], flags) + header['filename'].encode('utf-8'), 0
+
+
+def unpack_chunk(meta, frame_flags):
+    """Chunk request from metadata"""
+    chunk_index, flags = CHUNK_REQUEST.unpack_from(meta)
+    header = {
+        'filename': bytes(meta[CHUNK_REQUEST.size:]).decode('utf-8'),
+        'chunk_index': chunk_index
+    }
+    if flags & CHUNK_FLAG_PROOF:
+        header['proof'] = True
+    return header
+
+
+def pack_chunk_response(header):
+    """Chunk response metadata and frame flags (proof hashes as raw bytes, None = send as JSON)"""
+    encoding = header.get('encoding')
+    if encoding not in (None, 'zlib'):
+        return None
+    flags = CHUNK_FLAG_ZLIB if encoding else 0
+    proof = header.get('proof', [])
+    steps = b''.join(PROOF_STEP.pack(side.encode('ascii'), bytes.fromhex(sibling))
+                     for side, sibling in proof)
+    return (CHUNK_RESPONSE.pack(header['chunk_index'], header['chunk_size'], len(proof), flags)
+            + steps + header['filename'].encode('utf-8')), 0
+
+
+def unpack_chunk_response(meta, frame_flags):
+    """Chunk response from metadata"""
+    chunk_index, chunk_size, proof_len, flags = CHUNK_RESPONSE.unpack_from(meta)
+    offset = CHUNK_RESPONSE.size
+    proof = []
+    for _ in range(proof_len):
+        side, sibling = PROOF_STEP.unpack_from(meta, offset)
+        proof.append([side.decode('ascii'), sibling.hex()])
+        offset += PROOF_STEP.size
+    header = {
+        'filename': bytes(meta[offset:]).decode('utf-8'),
+        'chunk_index': chunk_index,
+        'chunk_size': chunk_size
+    }
+    if proof_len:
+        header['proof'] = proof
+    if flags & CHUNK_FLAG_ZLIB:
+        header['encoding'] = 'zlib'
+    return header
+
+
+def pack_info(header):
+    """Info request metadata and frame flags"""
+    return header['filename'].encode('utf-8'), 0
+
+
+def unpack_info(meta, frame_flags):
+    """Info request from metadata"""
+    return {'filename': bytes(meta).decode('utf-8')}
+
+
+def pack_info_response(header):
+    """Info response metadata and frame flags (None = send as JSON)
+
+    The chunk size is only there for peers that agreed on 'chunk_size',
+    so only they ever get the FLAG_CHUNK_SIZE layout.
+    """
+    info = header.get('info')
+    if info is None:
+        return None
+    fields = set(info)
+    if fields == INFO_FIELDS:
+        packed = FILE_INFO.pack(info['size'], info['num_chunks'],
+                                bytes.fromhex(info['hash']), bytes.fromhex(info['merkle_root']))
+        flags = 0
+    elif fields == INFO_FIELDS | {'chunk_size'}:
+        packed = FILE_INFO_SIZED.pack(info['size'], info['num_chunks'], info['chunk_size'],
+                                      bytes.fromhex(info['hash']), bytes.fromhex(info['merkle_root']))
+        flags = FLAG_CHUNK_SIZE
+    else:
+        # not hashed yet, or fields this packing doesn't know about: send JSON
+        return None
+    return packed + header['filename'].encode('utf-8'), flags
+
+
+def unpack_info_response(meta, frame_flags):
+    """Info response from metadata"""
+    if frame_flags & FLAG_CHUNK_SIZE:
+        size, num_chunks, chunk_size, file_hash, merkle_root = FILE_INFO_SIZED.unpack_from(meta)
+        offset = FILE_INFO_SIZED.size
+    else:
+        size, num_chunks, file_hash, merkle_root = FILE_INFO.unpack_from(meta)
+        chunk_size = None
+        offset = FILE_INFO.size
+    info = {
+        'size': size,
+        'hash': file_hash.hex(),
+        'num_chunks': num_chunks,
+        'merkle_root': merkle_root.hex()
+    }
+    if chunk_size is not None:
+        info['chunk_size'] = chunk_size
+    return {
+        'filename': bytes(meta[offset:]).decode('utf-8'),
+        'info': info
+    }
+
+
+# type -> (fields it can pack, pack (returns meta and frame flags), unpack)
+PACKERS = {
+    'chunk': (CHUNK_REQUEST_FIELDS, pack_chunk, unpack_chunk),
+    'chunk_response': (CHUNK_RESPONSE_FIELDS, pack_chunk_response, unpack_chunk_response),
+    'info': ({'filename'}, pack_info, unpack_info),
+    'info_response': ({'filename', 'info'}, pack_info_response, unpack_info_response),
+}
+
+
+class BinaryFraming:
+    """Version 2: fixed struct frame header + packed metadata + payload
+
+    The frame carries the message type, request id and both lengths.
+    Chunk and info messages pack their fields with struct (hashes as
+    raw bytes, not hex); everything else, or any message with fields
+    the packing doesn't know, carries compact JSON with FLAG_JSON set.
+    """
+
+    version = 2
+    prefix_size = FRAME.size
+
+    def encode(self, header, payload=None):
+        """Bytes to send before the payload"""
+        header = dict(header)
+        msg_type = header.pop('type', None)
+        request_id = header.pop('id', None)
+        header.pop('payload_size', None)
+        payload_size = len(payload) if payload is not None else 0
+
+        meta = None
+        flags = 0
+        packer = PACKERS.get(msg_type)
+        if packer and set(header) <= packer[0]:
+            packed = packer[1](header)
+            if packed is not None:
+                meta, flags = packed
+        if meta is None:
+            flags |= FLAG_JSON
+            if msg_type not in TYPE_CODES:
+                header['type'] = msg_type
+            meta = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+        code = TYPE_CODES.get(msg_type, TYPE_CODES['json'])
+        if request_id is None:
+            request_id = NO_ID
+        return FRAME.pack(code, flags, request_id, len(meta), payload_size) + meta
+
+    def meta_size(self, prefix):
+        """Bytes of metadata after the frame header"""
+        return FRAME.unpack(prefix)[3]
+
+    def decode(self, prefix, meta):
+        """Header dict (payload_size says how many payload bytes follow)
+
+        Raises ValueError for metadata that doesn't unpack.
+        """
+        code, flags, request_id, _, payload_size = FRAME.unpack(prefix)
+        msg_type = TYPE_NAMES.get(code)
+        if flags & FLAG_JSON:
+            header = decode_header(meta)
+        elif msg_type in PACKERS:
+            try:
+                header = PACKERS[msg_type][2](meta, flags)
+            except (struct.error, IndexError) as e:
+                raise ValueError(f"Malformed {msg_type} message: {e}")
+        else:
+            raise ValueError(f"Packed message of unknown type {code}")
+        if msg_type != 'json':
+            header['type'] = msg_type
+        header['id'] = None if request_id == NO_ID else request_id
+        if payload_size:
+            header['payload_size'] = payload_size
+        return header
+
+
+JSON_FRAMING = JsonFraming()
+BINARY_FRAMING = BinaryFraming()
+FRAMINGS = {
+    JSON_FRAMING.version: JSON_FRAMING,
+    BINARY_FRAMING.version: BINARY_FRAMING,
+}
+# Versions this node speaks (0 is the original bare JSON, handled separately)
+SUPPORTED_VERSIONS = sorted(FRAMINGS)
+# Optional behaviour agreed on in the hello ('choke': chunk requests may
+# be answered with 'choked' and a retry_after instead of the chunk;
+# 'chunk_size': file info carries a per-file chunk size and chunks are
+# counted in it, peers without it get 64KB chunks)
+FEATURES = ['choke', 'chunk_size']
+
+
+def choose_version(offered):
+    """Highest version both sides speak (1 if nothing matches)"""
+    common = set(offered or []) & set(SUPPORTED_VERSIONS)
+    return max(common) if common else JSON_FRAMING.version
+
+
+def send_message(sock, header, payload=None, framing=JSON_FRAMING):
+    """Send one framed message (header + optional raw payload), returns bytes sent"""
+    data = framing.encode(header, payload)
+    sock.sendall(data)
+    if payload:
+        send_payload(sock, payload)
+        return len(data) + len(payload)
+    return len(data)
+
+
+def recv_message(sock, framing=JSON_FRAMING):
+    """Read one framed message, returns (header, payload) or None on close
+
+    A timeout before the first byte is raised as socket.timeout (idle
+    connection); a timeout part way through a message is a ConnectionError
+    because the stream can't be resynced after that.
+    """
+    message = recv_sized_message(sock, framing)
+    if message is None:
+        return None
+    return message[:2]
+
+
+def recv_sized_message(sock, framing=JSON_FRAMING):
+    """recv_message that also returns the bytes read: (header, payload, size)"""
+    prefix = recv_exact(sock, framing.prefix_size)
+    if prefix is None:
+        return None
+    try:
+        meta_size = framing.meta_size(prefix)
+        check_size(meta_size, MAX_META_SIZE, "Message header")
+        meta = recv_exact(sock, meta_size)
+        if meta is None:
+            raise ConnectionError("Connection closed in the middle of a message")
+        try:
+            header = framing.decode(prefix, meta)
+        except ValueError as e:
+            # can't trust the rest of the stream after a garbled message
+            raise ConnectionError(f"Bad message: {e}")
+
+        payload = None
+        payload_size = header.get('payload_size', 0)
+        if payload_size:
+            if not isinstance(payload_size, int):
+                raise ConnectionError("Bad payload size")
+            check_size(payload_size, MAX_PAYLOAD_SIZE, "Payload")
+            payload = recv_exact(sock, payload_size)
+            if payload is None:
+                raise ConnectionError("Connection closed in the middle of a message")
+    except socket.timeout:
+        raise ConnectionError("Timed out in the middle of a message")
+    return header, payload, framing.prefix_size + meta_size + (len(payload) if payload else 0)
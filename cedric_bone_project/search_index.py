@@ -0,0 +1,122 @@
+"""
+Filename search index for P2P file sharing app
+"""
+import re
+import threading
+
+# Filename tokens are runs of letters and digits
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def trigrams(text):
+    """Every 3 character substring of text"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """Trigram and token inverted index over filenames
+
+    A term of 3+ characters is looked up through its rarest trigram and
+    only the filenames posted under it are checked, so a search doesn't
+    scan every filename. Shorter terms fall back to a scan. Kept up to
+    date incrementally with add/remove/update.
+
+    Queries are split into terms; a file matches if any term is a
+    substring of its name. Results are ranked by how many terms match,
+    whole-token matches count double, and the full query as a phrase
+    gets a bonus.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {}   # filename -> lowercase filename
+        self.grams = {}   # trigram -> set of filenames
+        self.tokens = {}  # token -> set of filenames
+
+    def add(self, filename):
+        """Index a filename"""
+        with self.lock:
+            self.add_locked(filename)
+
+    def remove(self, filename):
+        """Drop a filename"""
+        with self.lock:
+            self.remove_locked(filename)
+
+    def add_locked(self, filename):
+        """Index a filename (lock held)"""
+        if filename in self.names:
+            return
+        lower = filename.lower()
+        self.names[filename] = lower
+        for gram in trigrams(lower):
+            self.grams.setdefault(gram, set()).add(filename)
+        for token in TOKEN_RE.findall(lower):
+            self.tokens.setdefault(token, set()).add(filename)
+
+    def remove_locked(self, filename):
+        """Drop a filename (lock held)"""
+        lower = self.names.pop(filename, None)
+        if lower is None:
+            return
+        for gram in trigrams(lower):
+            self.discard(self.grams, gram, filename)
+        for token in TOKEN_RE.findall(lower):
+            self.discard(self.tokens, token, filename)
+
+    @staticmethod
+    def discard(postings, key, filename):
+        """Remove filename from a posting set (and the set if it's empty)"""
+        names = postings.get(key)
+        if names is None:
+            return
+        names.discard(filename)
+        if not names:
+            del postings[key]
+
+    def update(self, filenames):
+        """Make the index hold exactly filenames (only the difference is applied)"""
+        filenames = set(filenames)
+        with self.lock:
+            current = set(self.names)
+            for filename in current - filenames:
+                self.remove_locked(filename)
+            for filename in filenames - current:
+                self.add_locked(filename)
+
+    def matches(self, term):
+        """Filenames containing term (lock held)"""
+        if len(term) < 3:
+            return [name for name, lower in self.names.items() if term in lower]
+
+        # the rarest trigram gives the fewest candidates, checking those
+        # directly is cheaper than intersecting the other posting sets
+        candidates = None
+        for gram in trigrams(term):
+            names = self.grams.get(gram)
+            if not names:
+                return []
+            if candidates is None or len(names) < len(candidates):
+                candidates = names
+        return [name for name in candidates if term in self.names[name]]
+
+    def search(self, query):
+        """Filenames matching query, best match first"""
+        query = query.lower().strip()
+        terms = query.split()
+        with self.lock:
+            if not terms:
+                return sorted(self.names)
+
+            scores = {}
+            for term in set(terms):
+                exact = self.tokens.get(term, ())
+                for name in self.matches(term):
+                    scores[name] = scores.get(name, 0) + (2 if name in exact else 1)
+
+            if len(terms) > 1:
+                for name in scores:
+                    if query in self.names[name]:
+                        scores[name] += len(terms)
+
+        return sorted(scores, key=lambda name: (-scores[name], name))
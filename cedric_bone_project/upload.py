@@ -0,0 +1,389 @@
+"""
+Upload side (serving chunks) for P2P file sharing app
+"""
+import os
+import mmap
+import time
+import threading
+import collections
+
+# Served files kept open at once (least recently used are closed first)
+MAX_OPEN_FILES = 64
+# Bytes of recently served chunks kept in memory
+CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+# Chunks remembered after their first request (the second one caches them)
+SEEN_ENTRIES = 4096
+# Peers uploaded to at once, the rest are choked until a rechoke
+UPLOAD_SLOTS = 4
+# Seconds between rechokes
+RECHOKE_INTERVAL = 2.0
+# The optimistic unchoke moves on every this many rechokes
+OPTIMISTIC_ROUNDS = 3
+# A peer with no chunk request for this long isn't interested any more
+PEER_IDLE = 2 * RECHOKE_INTERVAL
+# An unchoked peer that stopped asking for this long is done, its slot is
+# given to a waiting peer without waiting for the rechoke
+SLOT_IDLE = 0.5
+
+
+class OpenFile:
+    """Open file shared by every request that reads it
+
+    Closed once it has been invalidated and the last user released it,
+    so a re-index never closes an fd that a sendfile is still using.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb', buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.users = 0
+        self.stale = False
+        self.map = None
+        self.map_lock = threading.Lock()
+
+    def read(self, offset, count):
+        """Bytes at offset, from a memory map of the file (mapped on first use)"""
+        # touching a mapping past the end of a file that shrank kills the
+        # process with SIGBUS, so make sure the bytes are still there
+        if os.fstat(self.file.fileno()).st_size < offset + count:
+            raise OSError(f"{self.file.name} shrank under us")
+        with self.map_lock:
+            if self.map is None:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + count]
+
+    def close(self):
+        """Unmap and close the file"""
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class FileHandleCache:
+    """Open fd and size per shared file, reused across chunk requests
+
+    At most max_open files stay open. Past that the least recently used
+    one is dropped like an invalidated one (closed once its last user
+    releases it).
+    """
+
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max(1, max_open)
+        self.handles = collections.OrderedDict()  # filename -> OpenFile, oldest first
+        self.lock = threading.Lock()
+
+    def acquire(self, filename, path):
+        """Open file for filename (opened on first use), must be released"""
+        with self.lock:
+            handle = self.handles.get(filename)
+            if handle is None:
+                handle = OpenFile(path)
+                self.handles[filename] = handle
+                while len(self.handles) > self.max_open:
+                    _, old = self.handles.popitem(last=False)
+                    self.retire(old)
+            else:
+                self.handles.move_to_end(filename)
+            handle.users += 1
+            return handle
+
+    @staticmethod
+    def retire(handle):
+        """Handle left the cache, close it now or on its last release (lock held)"""
+        handle.stale = True
+        if handle.users == 0:
+            handle.close()
+
+    def release(self, handle):
+        """Done with a handle from acquire"""
+        with self.lock:
+            handle.users -= 1
+            if handle.stale and handle.users == 0:
+                handle.close()
+
+    def invalidate(self, filename):
+        """File changed or is gone, next acquire reopens it"""
+        with self.lock:
+            handle = self.handles.pop(filename, None)
+            if handle is not None:
+                self.retire(handle)
+
+    def close_all(self):
+        """Invalidate every handle"""
+        with self.lock:
+            filenames = list(self.handles)
+        for filename in filenames:
+            self.invalidate(filename)
+
+
+class ChunkCache:
+    """Size-bounded LRU cache of recently served chunks
+
+    Keyed by (filename, file hash, chunk size, chunk index), so a
+    changed file never hits an old entry. A chunk is only cached on its
+    second request (the first one is remembered in a bounded seen list):
+    one peer streaming a big file once keeps going through sendfile and
+    doesn't push the popular chunks out.
+    """
+
+    def __init__(self, max_bytes=CHUNK_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.chunks = collections.OrderedDict()  # key -> bytes, oldest first
+        self.seen = collections.OrderedDict()    # key -> None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Cached chunk bytes, None on a miss"""
+        with self.lock:
+            data = self.chunks.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.chunks.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def want(self, key):
+        """Whether a missed chunk is worth reading into the cache"""
+        if self.max_bytes <= 0:
+            return False
+        with self.lock:
+            if key in self.seen:
+                del self.seen[key]
+                return True
+            self.seen[key] = None
+            if len(self.seen) > SEEN_ENTRIES:
+                self.seen.popitem(last=False)
+            return False
+
+    def put(self, key, data):
+        """Cache a chunk, evicting the least recently used ones to fit"""
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.chunks.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.chunks[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.chunks.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, filename):
+        """Drop every chunk of filename (it changed or is gone)"""
+        with self.lock:
+            for key in [k for k in self.chunks if k[0] == filename]:
+                self.size -= len(self.chunks.pop(key))
+            for key in [k for k in self.seen if k[0] == filename]:
+                del self.seen[key]
+
+    def clear(self):
+        """Drop everything"""
+        with self.lock:
+            self.chunks.clear()
+            self.seen.clear()
+            self.size = 0
+
+    def stats(self):
+        """Hit, miss and eviction counters and current size"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'chunks': len(self.chunks),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes
+            }
+
+
+class TokenBucket:
+    """Bandwidth limit: rate bytes/s with bursts of up to a second's worth
+
+    Sending may take the bucket below zero (a chunk is never split), the
+    debt is paid off before anything else goes out. rate 0 = no limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        """Add the tokens earned since the last call"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until the bucket is out of debt (0 = can send now)"""
+        if not self.rate:
+            return 0.0
+        self.refill(now)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def take(self, nbytes):
+        """Spend nbytes"""
+        if self.rate:
+            self.tokens -= nbytes
+
+
+class UploadPeer:
+    """Upload state of one downloading peer (one connection)"""
+
+    def __init__(self, peer, rate, now):
+        self.peer = peer
+        self.bucket = TokenBucket(rate)
+        self.unchoked = False
+        self.unchoked_at = 0.0
+        self.wants_since = now     # waiting for a slot since
+        self.last_request = None   # last chunk request that asked for a slot
+        self.last_active = now
+        self.sent = 0              # bytes this rechoke round
+
+
+class UploadScheduler:
+    """Upload slots with choke/unchoke and token bucket rate limits
+
+    Like a BitTorrent seed: at most slots peers are unchoked at once.
+    Every RECHOKE_INTERVAL the slots are given out again: slots - 1 go
+    to the peers we uploaded to fastest in the last round, one
+    (optimistic) slot rotates among the others, longest waiting first,
+    so every peer gets its turn. A free slot is handed out at once.
+    Choked peers get told when to ask again. Peers that didn't say they
+    understand choking are never choked, only rate limited.
+
+    Each peer has its own token bucket (peer_rate) and all of them share
+    one more (total_rate), both in bytes/s, 0 = no limit.
+    """
+
+    def __init__(self, slots=UPLOAD_SLOTS, peer_rate=0, total_rate=0):
+        self.slots = max(1, slots)
+        self.peer_rate = peer_rate
+        self.total = TokenBucket(total_rate)
+        self.peers = {}  # peer -> UploadPeer
+        self.optimistic = None
+        self.rounds = 0
+        self.last_rechoke = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get_peer(self, peer, now):
+        """State for peer (lock held)"""
+        state = self.peers.get(peer)
+        if state is None:
+            state = UploadPeer(peer, self.peer_rate, now)
+            self.peers[peer] = state
+        return state
+
+    def check(self, peer):
+        """None if peer may download now, else seconds until it should ask again"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.get_peer(peer, now)
+            state.last_request = state.last_active = now
+            if now - self.last_rechoke >= RECHOKE_INTERVAL:
+                self.rechoke(now)
+            if state.unchoked:
+                return None
+            unchoked = [p for p in self.peers.values() if p.unchoked]
+            for other in unchoked:
+                if now - other.last_request > SLOT_IDLE:
+                    self.choke(other, now)
+                    unchoked.remove(other)
+                    break
+            if len(unchoked) < self.slots:
+                self.unchoke(state, now)
+                return None
+            return max(0.1, self.last_rechoke + RECHOKE_INTERVAL - now)
+
+    def throttle(self, peer, nbytes):
+        """Seconds to wait before sending nbytes to peer, 0 = they're spent, send
+
+        peer None is only held to the total limit (one-off connections).
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self.get_peer(peer, now) if peer is not None else None
+            delay = self.total.delay(now)
+            if state is not None:
+                delay = max(delay, state.bucket.delay(now))
+            if delay > 0:
+                return delay
+            self.total.take(nbytes)
+            if state is not None:
+                state.bucket.take(nbytes)
+                state.sent += nbytes
+                state.last_active = now
+            return 0.0
+
+    def disconnect(self, peer):
+        """Peer went away, its slot is free"""
+        with self.lock:
+            self.peers.pop(peer, None)
+            if self.optimistic == peer:
+                self.optimistic = None
+
+    def unchoke(self, state, now):
+        """Give state a slot (lock held)"""
+        state.unchoked = True
+        state.unchoked_at = now
+
+    def choke(self, state, now):
+        """Take state's slot away (lock held)"""
+        state.unchoked = False
+        state.wants_since = now
+
+    def rechoke(self, now):
+        """Hand out the slots again (lock held)"""
+        self.last_rechoke = now
+        self.rounds += 1
+        interested = []
+        for state in list(self.peers.values()):
+            if now - state.last_active > PEER_IDLE * 30:
+                del self.peers[state.peer]
+                continue
+            if state.last_request is None or now - state.last_request > PEER_IDLE:
+                # not downloading anything (or never choked), let the slot go
+                if state.unchoked:
+                    self.choke(state, now)
+            else:
+                interested.append(state)
+
+        # fastest last round first, a tie goes to whoever had a slot first
+        ranked = sorted(interested, key=lambda s: (-s.sent, not s.unchoked, s.unchoked_at))
+        regular = ranked[:self.slots - 1]
+        rest = ranked[self.slots - 1:]
+
+        if self.optimistic not in [s.peer for s in rest] or self.rounds % OPTIMISTIC_ROUNDS == 0:
+            choked = [s for s in rest if not s.unchoked]
+            pick = min(choked or rest, key=lambda s: s.wants_since, default=None)
+            self.optimistic = pick.peer if pick else None
+
+        keep = set(s.peer for s in regular)
+        if self.optimistic is not None:
+            keep.add(self.optimistic)
+        for state in interested:
+            if state.peer in keep and not state.unchoked:
+                self.unchoke(state, now)
+            elif state.peer not in keep and state.unchoked:
+                self.choke(state, now)
+            state.sent = 0
+
+    def stats(self):
+        """Unchoked and choked peer counts"""
+        with self.lock:
+            chokeable = [p for p in self.peers.values() if p.last_request is not None]
+            unchoked = sum(1 for p in chokeable if p.unchoked)
+            return {
+                'slots': self.slots,
+                'unchoked': unchoked,
+                'choked': len(chokeable) - unchoked
+            }
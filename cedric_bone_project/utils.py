@@ -10,4 +10,15 @@ def find_free_port():
     # https://docs.python.org/3/howto/sockets.html INET
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind(('', 0))  # random port
-        return s.getsockname()[1]
\ No newline at end of file
+        return s.getsockname()[1]
+
+def format_eta(seconds):
+    """Seconds left as 1h02m, 3m05s or 42s ('?' if unknown)"""
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"